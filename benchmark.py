@@ -0,0 +1,169 @@
+import numpy as np
+
+import argparse
+import json
+import os
+import platform
+import time
+
+import torch
+
+import pianoRoll
+import syntheticMIDI
+from instrumentation import pipeline
+from datasetFromFile import MidiSavedDataset
+from datasetToFile import MidiToFile
+from importMIDI import ImportMIDI
+from models import Net
+
+
+def run_stage(results, name, fn, count_items):
+    """
+    Run fn once, time it and store the wall time and throughput of the
+    stage in results[name].
+
+    Parameters
+    ----------
+    results     : dict of stage results
+    name        : name of the stage
+    fn          : function running the stage
+    count_items : function of the output of fn returning the number of items processed
+
+    Returns
+    -------
+    output of fn
+    """
+    t0 = time.perf_counter()
+    output = fn()
+    seconds = time.perf_counter() - t0
+    items = count_items(output)
+    results[name] = {'seconds': seconds,
+                     'items': items,
+                     'items_per_second': items/seconds if seconds > 0 else 0.0}
+    print("%-16s %8.3f s  %10d items  %12.1f items/s" % (name, seconds, items, results[name]['items_per_second']))
+    return output
+
+
+def read_batches(dataset, batches):
+    count = 0
+    for indices in batches:
+        count += len(dataset.__getitems__(list(indices)))
+    return count
+
+
+def forward_passes(net, dataset, batch_size, num_batches):
+    items = dataset.__getitems__(list(range(min(batch_size, len(dataset)))))
+    x = torch.from_numpy(np.stack([data for data, labels in items]).astype(np.float32))
+    with torch.no_grad():
+        for _ in range(num_batches):
+            net(x)
+    return num_batches * x.shape[0]
+
+
+def forward_songs(net, songs):
+    positions = 0
+    with torch.no_grad():
+        for song in songs:
+            x = torch.from_numpy(pianoRoll.rasterize(song)[:384].astype(np.float32))
+            positions += net.forward_song(x).shape[0]
+    return positions
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'torch': torch.__version__,
+            'torch_threads': torch.get_num_threads()}
+
+
+def compare(results, baseline_file):
+    """
+    Print the throughput of every stage relative to a previous run
+    """
+    with open(baseline_file) as bf:
+        baseline = json.load(bf)
+    print("Relative to", baseline_file)
+    for name, stage in results['stages'].items():
+        if name in baseline['stages'] and baseline['stages'][name]['items_per_second'] > 0:
+            print("%-16s %6.2fx" % (name, stage['items_per_second']/baseline['stages'][name]['items_per_second']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every stage of the pipeline on a synthetic MIDI corpus")
+    parser.add_argument("--workdir", default="benchmark_data", help="directory of the corpus and dataset files")
+    parser.add_argument("--num-files", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=120.0, help="length of each song (s)")
+    parser.add_argument("--notes-per-second", type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--n-jobs", type=int, default=None, help="worker processes of the import and write stages")
+    parser.add_argument("--backend", default="hdf5", choices=["hdf5", "npy"])
+    parser.add_argument("--packed", action="store_true")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-batches", type=int, default=50)
+    parser.add_argument("--output", default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+
+    output_file   = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.baseline) if args.baseline is not None else None
+    corpus_dir    = os.path.abspath(os.path.join(args.workdir, "lmd_aligned"))
+    os.makedirs(args.workdir, exist_ok=True)
+
+    # Finer grained timings of the steps inside the stages
+    pipeline.enable()
+
+    stages = {}
+    files = run_stage(stages, "generate_corpus",
+                      lambda: syntheticMIDI.write_corpus(corpus_dir, args.num_files, args.seed, args.duration,
+                                                         args.notes_per_second),
+                      len)
+
+    imported = run_stage(stages, "import",
+                         lambda: ImportMIDI(num_files=args.num_files, n_jobs=args.n_jobs, verbose=False,
+                                            root_dir=corpus_dir),
+                         lambda im: im.report['files'])
+    songs = list(imported.get_midi_data()['notes'])
+
+    run_stage(stages, "rasterize", lambda: [pianoRoll.rasterize(song).shape[1] for song in songs], len)
+
+    # MidiToFile and MidiSavedDataset use files in the working directory
+    os.chdir(args.workdir)
+    written = run_stage(stages, "write",
+                        lambda: MidiToFile(songs, "train", backend=args.backend, packed=args.packed,
+                                           n_jobs=args.n_jobs),
+                        lambda mtf: mtf.report['songs'])
+
+    dataset = MidiSavedDataset("train", backend=args.backend)
+    rng = np.random.RandomState(args.seed)
+    random_batches = [rng.randint(0, len(dataset), args.batch_size) for _ in range(args.num_batches)]
+    sequential_batches = [np.arange(i * args.batch_size, (i + 1) * args.batch_size) % len(dataset)
+                          for i in range(args.num_batches)]
+    run_stage(stages, "read_random", lambda: read_batches(dataset, random_batches), lambda n: n)
+    run_stage(stages, "read_sequential", lambda: read_batches(dataset, sequential_batches), lambda n: n)
+
+    net = Net().eval()
+    run_stage(stages, "forward", lambda: forward_passes(net, dataset, args.batch_size, args.num_batches),
+              lambda n: n)
+    # Every window of a few whole songs, compare its items/s with forward
+    run_stage(stages, "forward_song", lambda: forward_songs(net, songs[:5]), lambda n: n)
+
+    results = {'config': vars(args),
+               'environment': environment(),
+               'corpus': {'files': len(files), 'songs': len(songs), 'chunks': written.length,
+                          'columns': int(written.report['columns'])},
+               'stages': stages,
+               'instrumentation': pipeline.report()}
+    with open(output_file, "w") as of:
+        json.dump(results, of, indent=2)
+    pipeline.print_report()
+    print("Results written to", output_file)
+
+    if baseline_file is not None:
+        compare(results, baseline_file)
+
+
+if __name__ == "__main__":
+    main()
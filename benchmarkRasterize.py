@@ -0,0 +1,69 @@
+import numpy as np
+
+import argparse
+import time
+
+import pretty_midi
+
+import pianoRoll
+
+
+def random_song(seed, duration = 240.0, notes_per_instrument = 2000):
+    """
+    Build a random PrettyMIDI song with one instrument per category.
+    """
+    rng = np.random.RandomState(seed)
+    pm = pretty_midi.PrettyMIDI()
+    for program in [0, 25, 41, 33]:
+        instrument = pretty_midi.Instrument(program=program)
+        starts = np.sort(rng.uniform(0, duration - 2.0, notes_per_instrument))
+        lengths = rng.uniform(0.05, 2.0, notes_per_instrument)
+        pitches = rng.randint(21, 109, notes_per_instrument)
+        for start, length, pitch in zip(starts, lengths, pitches):
+            instrument.notes.append(pretty_midi.Note(velocity=100, pitch=int(pitch),
+                                                     start=float(start), end=float(start + length)))
+        pm.instruments.append(instrument)
+    return pm
+
+
+def time_it(fn, songs, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        for song in songs:
+            fn(song)
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the per-note rasterization loop with pianoRoll.rasterize")
+    parser.add_argument("files", nargs="*", help="MIDI files to use instead of random songs")
+    parser.add_argument("--num-songs", type=int, default=10)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.files:
+        songs = [pretty_midi.PrettyMIDI(f) for f in args.files]
+    else:
+        songs = [random_song(seed) for seed in range(args.num_songs)]
+
+    # Both implementations must produce the same piano roll
+    for song in songs:
+        assert np.array_equal(pianoRoll.rasterize_loop(song), pianoRoll.rasterize(song))
+
+    notes = [pianoRoll.extract_notes(song) for song in songs]
+
+    loop_time       = time_it(pianoRoll.rasterize_loop, songs, args.repeats)
+    vector_time     = time_it(pianoRoll.rasterize, songs, args.repeats)
+    vector_time_pre = time_it(pianoRoll.rasterize, notes, args.repeats)
+
+    num_notes = sum(len(n.start) for n in notes)
+    print("Songs: ", len(songs), ", Notes: ", num_notes)
+    print("Loop (float64):            %.3f s" % loop_time)
+    print("Vectorized (uint8):        %.3f s  (%.1fx)" % (vector_time, loop_time/vector_time))
+    print("Vectorized from SongNotes: %.3f s  (%.1fx)" % (vector_time_pre, loop_time/vector_time_pre))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import numpy as np
+
+import argparse
+import copy
+import json
+import time
+
+import torch
+import torch.nn as nn
+
+import labelEncoder
+import pianoRoll
+import syntheticMIDI
+from dataset import MidiDataset
+from datasetFromFile import MidiSavedDataset, collate_chunks
+from models import Net, PRECISIONS, bf16_supported, parameter_dtype, precision_context
+
+
+def synthetic_chunks(num_songs, seed, duration = 60.0):
+    """
+    Return the chunks and single labels of random synthetic songs
+    """
+    songs = [pianoRoll.extract_notes(syntheticMIDI.synthetic_song(seed + i, duration)) for i in range(num_songs)]
+    dataset = MidiDataset(songs, "train")
+    items = [dataset[idx] for idx in range(len(dataset))]
+    data = np.stack([chunk for chunk, label in items])
+    labels = labelEncoder.encode_labels(np.stack([label for chunk, label in items]).T)[0].astype(np.int64)
+    return torch.from_numpy(data), torch.from_numpy(labels)
+
+
+def saved_chunks(data_type, backend, max_chunks, seed):
+    """
+    Return random chunks and single labels of a dataset written by MidiToFile
+    """
+    dataset = MidiSavedDataset(data_type, backend=backend)
+    rng = np.random.RandomState(seed)
+    indices = rng.choice(len(dataset), min(max_chunks, len(dataset)), replace=False)
+    return collate_chunks(dataset.__getitems__(list(indices)))
+
+
+def predict(net, data, precision, batch_size = 512):
+    outputs = []
+    with torch.no_grad(), precision_context(precision):
+        for start in range(0, len(data), batch_size):
+            outputs.append(net(data[start:start + batch_size]).double())
+    return torch.cat(outputs)
+
+
+def train(net, data, labels, precision, steps, batch_size, seed):
+    """
+    Train net for a number of steps with Adam on random batches, the same
+    batches for every precision. Returns the mean loss of the last 10 steps.
+    """
+    criterion = nn.CrossEntropyLoss()
+    optimizer = torch.optim.Adam(net.parameters(), lr=1e-3)
+    generator = torch.Generator().manual_seed(seed)
+    losses = []
+    for step in range(steps):
+        batch = torch.randint(0, len(data), (batch_size,), generator=generator)
+        optimizer.zero_grad()
+        with precision_context(precision):
+            loss = criterion(net(data[batch]), labels[batch])
+        loss.backward()
+        optimizer.step()
+        losses.append(loss.item())
+    return float(np.mean(losses[-10:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare Net in float64, float32 and bfloat16 on the same data and weights")
+    parser.add_argument("--data-type", default=None, help="use this MidiToFile split of the working directory "
+                                                          "instead of synthetic songs")
+    parser.add_argument("--backend", default="hdf5", choices=["hdf5", "npy"])
+    parser.add_argument("--num-songs", type=int, default=20, help="number of synthetic songs")
+    parser.add_argument("--max-chunks", type=int, default=20000)
+    parser.add_argument("--steps", type=int, default=300, help="training steps of each precision")
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="precision.json")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.data_type is not None:
+        data, labels = saved_chunks(args.data_type, args.backend, args.max_chunks, args.seed)
+    else:
+        data, labels = synthetic_chunks(args.num_songs, args.seed)
+        data, labels = data[:args.max_chunks], labels[:args.max_chunks]
+    num_train = int(0.8 * len(data))
+    train_data, train_labels = data[:num_train], labels[:num_train]
+    test_data, test_labels   = data[num_train:], labels[num_train:]
+    print("Chunks: ", len(data), ", Train: ", num_train, ", Test: ", len(test_data),
+          ", Native bfloat16: ", bf16_supported())
+
+    # Same initial weights for every precision
+    initial = Net().double()
+    results = {'chunks': len(data), 'native_bf16': bf16_supported(), 'precisions': {}}
+
+    # Inference of the initial weights, against float64
+    reference = predict(initial, test_data, "float64")
+    # Training from the initial weights, then inference of the trained weights against trained float64
+    trained = {}
+    for precision in PRECISIONS:
+        net = copy.deepcopy(initial).to(parameter_dtype(precision))
+
+        t0 = time.perf_counter()
+        outputs = predict(net, test_data, precision)
+        inference_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        final_loss = train(net, train_data, train_labels, precision, args.steps, args.batch_size, args.seed)
+        train_seconds = time.perf_counter() - t0
+        trained[precision] = predict(net, test_data, precision)
+
+        results['precisions'][precision] = {
+            'max_abs_logit_diff': float((outputs - reference).abs().max()),
+            'argmax_agreement': float((outputs.argmax(1) == reference.argmax(1)).double().mean()),
+            'inference_chunks_per_second': len(test_data)/inference_seconds,
+            'train_steps_per_second': args.steps/train_seconds,
+            'final_train_loss': final_loss,
+            'test_accuracy': float((trained[precision].argmax(1) == test_labels).double().mean())}
+
+    for precision in PRECISIONS:
+        stats = results['precisions'][precision]
+        stats['trained_argmax_agreement'] = float((trained[precision].argmax(1) ==
+                                                   trained["float64"].argmax(1)).double().mean())
+        print("%-9s max |logit diff| %.2e, argmax agreement %.4f, %8.0f chunks/s, %6.1f steps/s, "
+              "loss %.4f, test accuracy %.4f, trained argmax agreement %.4f"
+              % (precision, stats['max_abs_logit_diff'], stats['argmax_agreement'],
+                 stats['inference_chunks_per_second'], stats['train_steps_per_second'], stats['final_train_loss'],
+                 stats['test_accuracy'], stats['trained_argmax_agreement']))
+
+    with open(args.output, "w") as of:
+        json.dump(results, of, indent=2)
+
+
+if __name__ == "__main__":
+    main()
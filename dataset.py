@@ -10,30 +10,36 @@ from torch.utils.data import Dataset
 # PANDAS
 import pandas as pd
 
+import pianoRoll
+
 
 class MidiDataset(Dataset):
     """MIDI dataset."""
 
-    def __init__(self, data, data_type = "train"):
+    def __init__(self, data, data_type = "train", sparse = True, grid = None):
         """
-        Args:None 
+        Args:
+            data      : series of songs (PrettyMIDI objects or SongNotes)
+            data_type : "train", "val" or "test"
+            sparse    : keep each song as note intervals and build the dense
+                        windows in __getitem__ instead of storing dense songs
+            grid      : pianoRoll.TimeGrid of the columns (10 ms timeslices if None)
         """
         self.data_type = data_type
         self.all_instruments_df = data
+        self.sparse = sparse
+        self.grid = grid
 
-        self.list_of_songs       = []
-        self.label_list_of_songs = []
-        
-        self.f_list_of_songs       = []
-        self.f_label_list_of_songs = []
+        # Piano roll of every song: SparsePianoRoll in sparse mode, dense array otherwise
+        self.songs = []
         
         self.chunk_step_size = 1
+        self.chunk_size = 50
 
         if self.data_type == "train" or self.data_type == "val":
             self.chunk_step_size = 10
                 
         self.construct_list_of_songs()
-        self.flatten_data() 
         
         
         
@@ -41,107 +47,62 @@ class MidiDataset(Dataset):
         """
         Return the length of the dataset  
         """
-        return len(self.f_list_of_songs)
+        return int(self.chunk_offsets[-1])
 
 
     def __getitem__(self, idx):
         """
         Return the idx-th element of the dataset  
         """
-        return self.f_list_of_songs[idx], self.f_label_list_of_songs[idx]
+        num_notes       = pianoRoll.NUM_NOTES
+        num_instruments = pianoRoll.NUM_INSTRUMENTS
+
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("index out of range")
+
+        # Find the song the chunk belongs to and where the chunk starts in it
+        song_idx = np.searchsorted(self.chunk_offsets, idx, side="right") - 1
+        start_index = int(idx - self.chunk_offsets[song_idx]) * self.chunk_step_size
+        end_index   = start_index + self.chunk_size
+        label_index = start_index + int(self.chunk_size/2)
+
+        song = self.songs[song_idx]
+        if self.sparse:
+            chunk = song.window(start_index, end_index, 0, num_notes*(num_instruments-1))
+            label = song.column(label_index, num_notes*(num_instruments-1), num_notes*num_instruments)
+        else:
+            chunk = song[0:num_notes*(num_instruments-1), start_index:end_index]
+            label = song[num_notes*(num_instruments-1):num_notes*num_instruments, label_index]
+        return chunk, label
  
     
-    def instrument_to_index(self, instrument):
-        """
-        Return the index of the category the instrument belongs to 
-        
-        Parameters
-        ----------
-        Instrument : instrument program number
-
-        Returns
-        -------
-        0  : instrument program number is in the piano category 
-        1  : instrument program number is in the guitar category
-        2  : instrument program number is in the string category
-        3  : instrument program number is in the bass category
-        -1 : instrument program number is not in our of the four desired categories
-        """
-        piano_program_numbers  = set([0, 1, 2, 3, 4])
-        guitar_program_numbers = set([25, 26, 27, 28, 29])
-        bass_program_numbers   = set([33, 34, 35, 36, 37, 38, 52])
-        string_program_numbers = set([41, 42, 43, 49, 50, 51])
-
-        if instrument in piano_program_numbers:
-            return 0
-        elif instrument in guitar_program_numbers:
-            return 1
-        elif instrument in string_program_numbers:
-            return 2 
-        elif instrument in bass_program_numbers:
-            return 3
-        else:
-            return -1
-          
-
     def construct_list_of_songs(self):
         """
-        Import an array of midi files and output a list of songs 
-        where each song is composed of a list of chunks and each 
-        chunk is a numpy array. 
+        Import an array of midi files and output a list of songs, one piano
+        roll per song, and the offsets of the first chunk of each song.
 
+        Chunks are not stored: chunk idx of the dataset is found from
+        chunk_offsets and sliced out of its song in __getitem__.
         """
-        T = 0.010   # Timestep (s)
-        chunk_size      = 50
-        chunk_offset    = self.chunk_step_size
-        num_notes       = 128
-        num_instruments = 4
+        chunk_size   = self.chunk_size
+        chunk_offset = self.chunk_step_size
         
-        # Iterate through every midi and extract chunks in each song 
-#         for idx, row in self.all_instruments_df.iterrows():
-        for idx, row in self.all_instruments_df.items():
-#             t_end = row["midi"].get_end_time()
-            t_end = row.get_end_time()
-            num_timeslices = int(t_end/T)
-
-            # Create data array to store all of the notes in the song based on the timestep they are played in 
-            data = np.zeros((num_notes * num_instruments, num_timeslices)) # rows: notes, instruments, cols: timeslices
-            
-#             for instrument in row["midi"].instruments:
-            for instrument in row.instruments:
-                index = self.instrument_to_index(instrument.program)
-                if (index != -1):
-                    for note in instrument.notes:
-                        data[num_notes * index + note.pitch, math.floor(note.start/T):math.floor(note.end/T)] = 1   
-
-            # Create chunks for a single song given its data array 
-            list_of_chunks       = []
-            list_of_chunk_labels = []
-            start_index = 0
-            end_index   = start_index + chunk_size
-            while(end_index < num_timeslices):
-                chunk = data[0:num_notes*(num_instruments-1),start_index:end_index]
-                label = data[num_notes*(num_instruments-1):num_notes * num_instruments,start_index + int(chunk_size/2)]
-                list_of_chunks.append(chunk)
-                list_of_chunk_labels.append(label)
-                start_index = start_index + chunk_offset
-                end_index = start_index + chunk_size
-
-            self.list_of_songs.append(list_of_chunks)
-            self.label_list_of_songs.append(list_of_chunk_labels)
-            
-            
-    def flatten_data(self): 
-        """
-        Flatten each set into a list of chunks. 
-        """
-        # Flatten data 
-        for song_list in self.list_of_songs:
-            for chunk in song_list:
-                self.f_list_of_songs.append(chunk)
-     
-        for song_list in self.label_list_of_songs:
-            for chunk in song_list:
-                self.f_label_list_of_songs.append(chunk)
-
-        
\ No newline at end of file
+        num_chunks = []
+        # Iterate through every midi and count the chunks in each song 
+        for idx, row in enumerate(pianoRoll.iter_songs(self.all_instruments_df)):
+            if self.sparse:
+                song = pianoRoll.SparsePianoRoll(row, self.grid)
+                num_timeslices = song.num_timeslices
+            else:
+                # Create data array to store all of the notes in the song based on the timestep they are played in 
+                song = pianoRoll.rasterize(row, grid=self.grid) # rows: notes, instruments, cols: timeslices
+                num_timeslices = song.shape[1]
+            self.songs.append(song)
+
+            # Chunks start every chunk_offset columns and must end before the last column
+            num_chunks.append(len(range(0, num_timeslices - chunk_size, chunk_offset)))
+
+        self.chunk_offsets = np.zeros(len(num_chunks) + 1, dtype=np.int64)
+        self.chunk_offsets[1:] = np.cumsum(num_chunks)
@@ -5,75 +5,225 @@ import collections
 import math
 
 # PYTORCH 
+import torch
 from torch.utils.data import Dataset
 
 # PANDAS
 import pandas as pd
 
 import h5py
+import json
+import os
 import pickle as pkl
 
+from datasetToFile import CHUNK_INDEX_STEP, chunk_index
+import labelEncoder
+import pianoRoll
+from instrumentation import pipeline
+
+
+def collate_chunks(items):
+    """
+    DataLoader collate_fn for MidiSavedDataset: stack a batch of chunks
+    with one copy each for the data and the labels, keeping the compact
+    stored dtype. Net casts the data to the dtype of its weights once per
+    batch.
+
+    Returns
+    -------
+    data   : (batch, 384, window) uint8 tensor
+    labels : (batch,) int64 tensor of pitches for single label modes (as
+             expected by CrossEntropyLoss), (batch, 128) uint8 tensor for
+             multihot labels
+    """
+    data   = np.stack([chunk for chunk, label in items])
+    labels = np.stack([label for chunk, label in items])
+    if labels.shape[1] == 1:
+        labels = labels[:, 0].astype(np.int64)
+    return torch.from_numpy(data), torch.from_numpy(labels)
+
 
 class MidiSavedDataset(Dataset):
     """MIDI dataset."""
 
-    def __init__(self, data_type = "train"):
+    def __init__(self, data_type = "train", format_version = None, backend = "hdf5", cache_bytes = 0,
+                 label_mode = "single", grid = None, window = None, stride = None, label_offset = None,
+                 max_length = None):
         """
-        Args:None 
+        Args:
+            data_type      : "train", "val" or "test"
+            format_version : HDF5 layout written by MidiToFile, 1 (one dataset
+                             per song) or 2 (single dataset with offsets). If
+                             None, format 2 is used when its file exists.
+            backend        : "hdf5" to read the HDF5 files, "npy" to memory-map
+                             the .npy files written by MidiToFile(backend="npy")
+            cache_bytes    : memory budget of the cache of decoded songs kept by
+                             each process (no cache if 0), see read_song
+            label_mode     : labels returned with each chunk, one of the modes stored
+                             by MidiToFile(label_modes=...): "single", "highest" or
+                             "lowest" give the pitch (128 for no bass note),
+                             "multihot" gives the 128 bass rows (see labelEncoder)
+            grid           : pianoRoll.TimeGrid the caller expects, a ValueError is
+                             raised if the files were written on another grid.
+                             The grid of the files is in self.grid
+            window         : number of columns of each chunk (chunk size of the
+                             build if None)
+            stride         : columns between the starts of two consecutive chunks
+                             (chunk step of the build if None)
+            label_offset   : column of the chunk whose label is returned (window//2
+                             if None)
+            max_length     : only use the first max_length chunks (all if None)
+
+        Chunks other than the ones of the build are indexed from the song
+        lengths when the dataset is created, without rewriting the files.
+        Deduplicated chunk lists (MidiToFile(dedup=...)) only apply to the
+        chunks of the build.
         """
         self.data_type = data_type
+        self.backend = backend
+
+        # Least recently used cache of decoded songs: song -> (data, labels)
+        self.cache_bytes  = cache_bytes
+        self.song_cache   = collections.OrderedDict()
+        self.cached_bytes = 0
+        self.cache_hits   = 0
+        self.cache_misses = 0
             
         self.dict_of_where_to_look = {}
         
         self.filename = "V3" + data_type + '.hdf5'
         self.filename_labels = "V3" + data_type + "Labels.hdf5"
+        self.filename_v2 = "V3" + data_type + "V2.hdf5"
+
+        if format_version is None:
+            format_version = 2 if os.path.exists(self.filename_v2) else 1
+        self.format_version = format_version
             
+        # File handles, opened on first access in each DataLoader worker
         self.hf_read = None
         self.hf_read_labels = None
+        self.npy_data   = None
+        self.npy_labels = None
+
+        # Start of each song in the format 2 data/labels datasets or in the .npy files
+        self.offsets = None
+        # Bit-packed song data (see MidiToFile.encode_song) and its number of unpacked rows
+        self.packed   = False
+        self.num_rows = None
+        # Label modes in the files, files written before label modes only have single labels
+        stored_label_modes = "single"
+        # Layout of the files, files written before it was saved use the 10 ms grid and all pitches
+        meta = {}
+        # Run-length encoded files: run_offsets[i] is the column where the i-th stored
+        # column starts, counting the columns of all songs (see MidiToFile(run_length=True))
+        self.run_offsets = None
+        run_lengths = None
+        if self.backend == "npy":
+            self.offsets = np.load("V3" + data_type + "Offsets.npy")
+            with open("V3" + data_type + "Meta.json") as jf:
+                meta = json.load(jf)
+            self.packed   = meta['packed']
+            self.num_rows = meta['num_rows']
+            stored_label_modes = meta.get('label_modes', stored_label_modes)
+            if meta.get('run_length', False):
+                run_lengths = np.load("V3" + data_type + "RunLengths.npy", mmap_mode='r')
+        elif self.format_version == 2:
+            with h5py.File(self.filename_v2, 'r') as hf:
+                meta = dict(hf.attrs)
+                self.offsets  = hf['offsets'][:]
+                self.packed   = bool(hf.attrs.get('packed', False))
+                self.num_rows = int(hf.attrs.get('num_rows', hf['data'].shape[0]))
+                stored_label_modes = str(hf.attrs.get('label_modes', stored_label_modes))
+                if hf.attrs.get('run_length', False):
+                    run_lengths = hf['run_lengths'][:]
+        if run_lengths is not None:
+            self.run_offsets = np.zeros(len(run_lengths) + 1, dtype=np.int64)
+            self.run_offsets[1:] = np.cumsum(run_lengths)
+
+        self.grid = pianoRoll.TimeGrid.from_meta(meta)
+        if grid is not None and grid != self.grid:
+            raise ValueError("The %s files were written on %r, not %r" % (data_type, self.grid, grid))
+        self.pitch_range = (int(meta.get('min_pitch', 0)), int(meta.get('max_pitch', pianoRoll.NUM_NOTES - 1)))
+        if self.pitch_range != (0, pianoRoll.NUM_NOTES - 1):
+            raise ValueError("The %s files have pitches %d to %d, expected 0 to %d"
+                             % ((data_type,) + self.pitch_range + (pianoRoll.NUM_NOTES - 1,)))
+
+        # Labels returned and labels read: highest pitch labels are the single labels
+        self.label_mode   = label_mode
+        self.stored_label = "single" if label_mode == "highest" else label_mode
+        if self.stored_label not in stored_label_modes.split(","):
+            raise ValueError("Label mode %r is not stored in the %s files, they have %s"
+                             % (label_mode, data_type, stored_label_modes))
 #         self.hf_read        = h5py.File(filename, 'r')
 #         self.hf_read_labels = h5py.File(filename_labels, 'r')
-        if (data_type == 'train'): 
-            with open("V3trainOther.pkl", "rb") as pf:
-                self.length, self.dict_of_where_to_look = pkl.load(pf)
-        elif (data_type == 'val'):
-            with open("V3valOther.pkl", "rb") as pf:
-                self.length, self.dict_of_where_to_look = pkl.load(pf)
-        elif (data_type == 'test'): 
-            with open("V3testOther.pkl", "rb") as pf: 
+
+        # Chunks: window columns starting every stride columns, labelled by column
+        # label_offset of the chunk, and ending before the last column of the song
+        build_size = int(meta.get('chunk_size', 50))
+        build_step = int(meta.get('chunk_step', CHUNK_INDEX_STEP))
+        self.chunk_size   = int(window) if window is not None else build_size
+        self.chunk_step   = int(stride) if stride is not None else build_step
+        self.label_offset = int(label_offset) if label_offset is not None else self.chunk_size//2
+        if self.chunk_size <= 0 or self.chunk_step <= 0 or self.label_offset < 0:
+            raise ValueError("window and stride must be positive and label_offset non-negative, got %d, %d, %d"
+                             % (self.chunk_size, self.chunk_step, self.label_offset))
+        # Columns read for each chunk
+        self.read_span = max(self.chunk_size, self.label_offset + 1)
+        build_chunks = (self.chunk_size, self.chunk_step, self.label_offset) == (build_size, build_step, build_size//2)
+        self.max_length = max_length
+
+        # Chunk index: memory-mapped chunk offsets saved by MidiToFile or computed
+        # from the song lengths (see datasetToFile.chunk_index), or the dict
+        # pickled by older versions of MidiToFile
+        self.chunk_offsets = None
+        # Largest span of columns between chunk starts read at once by __getitems__
+        self.max_read_columns = 1024
+        indexname = "V3" + data_type + "Index.npy"
+        if build_chunks and os.path.exists(indexname):
+            self.chunk_offsets = np.load(indexname, mmap_mode='r')
+            self.length = int(self.chunk_offsets[-1])
+        elif build_chunks and os.path.exists("V3" + data_type + "Other.pkl"):
+            with open("V3" + data_type + "Other.pkl", "rb") as pf:
                 self.length, self.dict_of_where_to_look = pkl.load(pf)
+        else:
+            self.chunk_offsets = chunk_index(self.song_lengths(), max(self.chunk_size, self.label_offset),
+                                             self.chunk_step)
+            self.length = int(self.chunk_offsets[-1])
+
+        # Chunks kept by MidiToFile(dedup=...) and, for dedup="weight", the number
+        # of copies of each of them in the full split (for a WeightedRandomSampler)
+        self.chunks        = None
+        self.chunk_weights = None
+        if build_chunks and self.chunk_offsets is not None and os.path.exists("V3" + data_type + "Chunks.npy"):
+            self.chunks = np.load("V3" + data_type + "Chunks.npy", mmap_mode='r')
+            self.length = len(self.chunks)
+            if os.path.exists("V3" + data_type + "ChunkWeights.npy"):
+                self.chunk_weights = np.load("V3" + data_type + "ChunkWeights.npy")
                 
+    def __getstate__(self):
+        # Open files are not sent to the DataLoader workers, each worker opens its own
+        state = self.__dict__.copy()
+        state['hf_read']        = None
+        state['hf_read_labels'] = None
+        state['npy_data']       = None
+        state['npy_labels']     = None
+        # Each worker fills its own song cache
+        state['song_cache']     = collections.OrderedDict()
+        state['cached_bytes']   = 0
+        return state
+
     def __del__(self):
-        self.hf_read.close()
-        self.hf_read_labels.close()
+        if self.hf_read is not None:
+            self.hf_read.close()
+        if self.hf_read_labels is not None:
+            self.hf_read_labels.close()
         
     def __len__(self):
         """
         Return the length of the dataset  
         """
-#         if (self.data_type == "train"): 
-#             return 150000
-#         else: 
-#             return 18750
-        
-#         if (self.data_type == "train"): 
-#             return 30000
-#         else: 
-#             return 3750
-
-#         if (self.data_type == "train"): 
-#             return 5000
-#         else: 
-#             return 625
-        
-        if (self.data_type == "train"): 
-            return 100000
-        else: 
-            return 12500
-
-#         if (self.data_type == "train"): 
-#             return 50
-#         else: 
-#             return 10
+        if self.max_length is not None:
+            return min(self.length, self.max_length)
         return self.length
 
 
@@ -81,26 +231,23 @@ class MidiSavedDataset(Dataset):
         """
         Return the idx-th element of the dataset  
         """
-        data = []
-        labels = []
-        
+        if self.chunk_offsets is not None:
+            return self.get_chunk(idx)
+
+        # Chunks pickled by older versions of MidiToFile
         if self.hf_read is None:
             self.hf_read = h5py.File(self.filename, 'r')
         if self.hf_read_labels is None:
             self.hf_read_labels = h5py.File(self.filename_labels, 'r')
                
         # Data CNN
-        song, chunk = self.dict_of_where_to_look[idx]
+        song, chunk = self.locate_chunk(idx)
         data = self.hf_read[str(song)][:, chunk[0]:chunk[1]]
 
         # Labels
-        song, chunk = self.dict_of_where_to_look[idx]
-        mid_index = chunk[0] + (chunk[1]-chunk[0])/2.0
+        mid_index = chunk[0] + (chunk[1]-chunk[0])//2
         labels = self.hf_read_labels[str(song)][:,mid_index]
 
-
-    
-
 #         # Data SVM
 #         song, chunk = self.dict_of_where_to_look[idx]
 # #         print("Song: ", song, ", Chunk: ", chunk)
@@ -111,6 +258,204 @@ class MidiSavedDataset(Dataset):
         
         
         return data, labels
+
+    def __getitems__(self, indices):
+        """
+        Return the elements of a list of indices (used by the DataLoader to
+        fetch a whole batch at once).
+
+        The chunks are grouped by song and each group of nearby chunks is
+        read with a single read covering all of them, then the chunks are
+        sliced out of it in memory.
+        """
+        with pipeline.stage("read", len(indices)):
+            if self.chunk_offsets is None:
+                return [self[idx] for idx in indices]
+
+            idx    = np.asarray(indices, dtype=np.int64)
+            if self.chunks is not None:
+                idx = self.chunks[idx]
+            songs  = np.searchsorted(self.chunk_offsets, idx, side="right") - 1
+            starts = (idx - self.chunk_offsets[songs]) * self.chunk_step
+            order  = np.lexsort((starts, songs))
+
+            items = [None] * len(idx)
+            group_begin = 0
+            while group_begin < len(order):
+                # Extend the group while the chunks are in the same song and the read stays small
+                song = songs[order[group_begin]]
+                lo   = starts[order[group_begin]]
+                group_end = group_begin + 1
+                while group_end < len(order) and songs[order[group_end]] == song and \
+                      starts[order[group_end]] - lo <= self.max_read_columns:
+                    group_end += 1
+                hi = starts[order[group_end - 1]] + self.read_span
+
+                data, labels = self.read_columns(int(song), int(lo), int(hi))
+                for j in order[group_begin:group_end]:
+                    start = starts[j] - lo
+                    items[j] = (data[:, start:start + self.chunk_size],
+                                labels[:, start + self.label_offset])
+                group_begin = group_end
+
+            return items
+
+    def read_columns(self, song, start, end):
+        """
+        Return the data and labels of columns start:end of a song with one
+        read from each dataset, or from the song cache if it is enabled
+        """
+        if self.cache_bytes > 0:
+            cached = self.read_song(song)
+            if cached is not None:
+                data, labels = cached
+                return data[:, start:end], labels[:, start:end]
+        return self.read_stored_columns(song, start, end)
+
+    def read_song(self, song):
+        """
+        Return the decoded data and labels of a whole song from the song
+        cache, reading and caching it on a miss. Least recently used songs
+        are dropped to stay within cache_bytes.
+
+        Returns None for songs larger than the whole cache.
+        """
+        if song in self.song_cache:
+            self.song_cache.move_to_end(song)
+            self.cache_hits += 1
+            return self.song_cache[song]
+
+        self.cache_misses += 1
+        length = self.song_length(song)
+        if length * (self.num_song_rows() + self.num_label_rows()) > self.cache_bytes:
+            return None
+
+        data, labels = self.read_stored_columns(song, 0, length)
+        size = data.nbytes + labels.nbytes
+        while self.song_cache and self.cached_bytes + size > self.cache_bytes:
+            _, (old_data, old_labels) = self.song_cache.popitem(last=False)
+            self.cached_bytes -= old_data.nbytes + old_labels.nbytes
+
+        self.song_cache[song] = (data, labels)
+        self.cached_bytes += size
+        return data, labels
+
+    def cache_info(self):
+        """
+        Return the hit/miss counters and the size of the song cache
+        """
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'songs': len(self.song_cache),
+                'bytes': self.cached_bytes,
+                'max_bytes': self.cache_bytes}
+
+    def song_lengths(self):
+        """
+        Return the number of columns of every song
+        """
+        if self.run_offsets is not None:
+            return self.run_offsets[self.offsets[1:]] - self.run_offsets[self.offsets[:-1]]
+        if self.offsets is not None:
+            return np.diff(self.offsets)
+
+        manifest_name = "V3" + self.data_type + "Manifest.jsonl"
+        if os.path.exists(manifest_name):
+            with open(manifest_name) as mf:
+                return np.array([json.loads(line)['length'] for line in mf], dtype=np.int64)
+        with h5py.File(self.filename, 'r') as hf:
+            return np.array([hf[str(song)].shape[1] for song in range(len(hf))], dtype=np.int64)
+
+    def song_length(self, song):
+        if self.run_offsets is not None:
+            return int(self.run_offsets[self.offsets[song + 1]] - self.run_offsets[self.offsets[song]])
+        if self.offsets is not None:
+            return int(self.offsets[song + 1] - self.offsets[song])
+        if self.hf_read is None:
+            self.hf_read = h5py.File(self.filename, 'r')
+        return self.hf_read[str(song)].shape[1]
+
+    def num_song_rows(self):
+        if self.num_rows is not None:
+            return self.num_rows
+        return 384
+
+    def num_label_rows(self):
+        if self.label_mode == "multihot":
+            return 128
+        return 1
+
+    def read_stored_columns(self, song, start, end):
+        """
+        Read the data and labels of columns start:end of a song from the
+        files, expanding run-length encoded columns and unpacking packed data
+        """
+        if self.run_offsets is None:
+            data, labels = self.read_stored_range(song, start, end)
+        else:
+            # Stored column of each column, then one read covering all of them
+            first  = int(self.offsets[song])
+            base   = self.run_offsets[first]
+            stored = np.searchsorted(self.run_offsets, np.arange(base + start, base + end), side="right") - 1 - first
+            lo, hi = int(stored[0]), int(stored[-1]) + 1
+            data, labels = self.read_stored_range(song, lo, hi)
+            data, labels = data[:, stored - lo], labels[:, stored - lo]
+
+        if self.packed:
+            data = np.unpackbits(data, axis=0, count=self.num_rows)
+        return data, labelEncoder.decode_labels(labels, self.stored_label)
+
+    def read_stored_range(self, song, start, end):
+        """
+        Read the stored columns start:end of a song, as they are in the files
+        """
+        if self.backend == "npy":
+            if self.npy_data is None:
+                # Memory-mapped: reads go through the OS page cache shared by all workers
+                self.npy_data   = np.load("V3" + self.data_type + "Data.npy", mmap_mode='r')
+                self.npy_labels = np.load("V3" + self.data_type + "Labels" + labelEncoder.label_suffix(self.stored_label)
+                                          + ".npy", mmap_mode='r')
+            offset = int(self.offsets[song])
+            data   = self.npy_data[offset + start:offset + end].T
+            if not self.packed:
+                data = np.array(data)
+            labels = np.array(self.npy_labels[offset + start:offset + end].T)
+        elif self.format_version == 2:
+            if self.hf_read is None:
+                self.hf_read = h5py.File(self.filename_v2, 'r')
+            offset = int(self.offsets[song])
+            data   = self.hf_read['data'][:, offset + start:offset + end]
+            labels = self.hf_read['labels' + labelEncoder.label_suffix(self.stored_label)][:, offset + start:offset + end]
+        else:
+            if self.hf_read is None:
+                self.hf_read = h5py.File(self.filename, 'r')
+            if self.hf_read_labels is None:
+                self.hf_read_labels = h5py.File(self.filename_labels, 'r')
+            data   = self.hf_read[str(song)][:, start:end]
+            labels = self.hf_read_labels[str(song)][:, start:end]
+        return data, labels
+
+    def locate_chunk(self, idx):
+        """
+        Return the song of the idx-th chunk and its (start, end) columns in the song
+        """
+        if self.chunk_offsets is None:
+            return self.dict_of_where_to_look[idx]
+
+        if self.chunks is not None:
+            idx = self.chunks[idx]
+        song  = int(np.searchsorted(self.chunk_offsets, idx, side="right")) - 1
+        start = int(idx - self.chunk_offsets[song]) * self.chunk_step
+        return song, (start, start + self.chunk_size)
+
+    def get_chunk(self, idx):
+        """
+        Return the idx-th element of a dataset with a chunk index
+        """
+        with pipeline.stage("read"):
+            song, chunk = self.locate_chunk(idx)
+            data, labels = self.read_columns(song, chunk[0], chunk[0] + self.read_span)
+            return data[:, :self.chunk_size], labels[:, self.label_offset]
     
 
     
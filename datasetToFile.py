@@ -12,20 +12,551 @@ import pandas as pd
 
 import h5py
 import pickle as pkl
+import json
+import functools
+import hashlib
+import multiprocessing
+import os
+import time
+
+import labelEncoder
+import pianoRoll
+from instrumentation import Laps, pipeline
+
+# Layout written by MidiToFile by default, see H5SongWriter
+FORMAT_VERSION = 2
+
+# Columns between the starts of two consecutive chunks in the saved chunk index
+CHUNK_INDEX_STEP = 10
+
+# Rows of the saved song data: the notes of the piano, guitar and string instruments
+NUM_SONG_ROWS = pianoRoll.NUM_NOTES * (pianoRoll.NUM_INSTRUMENTS - 1)
+
+
+def encode_song(song, packed):
+    """
+    Return a song as it is stored: bit-packed along the pitch axis in
+    packed mode, unchanged otherwise
+    """
+    if packed:
+        return np.packbits(song != 0, axis=0)
+    return song
+
+
+def sounding_roll(song, grid = None):
+    """
+    Return the (512, timeslices) piano roll of a song on the grid (see
+    pianoRoll.TimeGrid) without its silent timeslices
+    """
+    # Create data array to store all of the notes in the song based on the timestep they are played in 
+    data = pianoRoll.rasterize(song, grid=grid)
+    return data[:,~(data==0).all(axis=0)]
+
+
+def encode_roll(filtered_data, packed = False, label_modes = ("single",)):
+    """
+    Split a 512 row piano roll into the stored input rows and the labels
+    encoded from its bass rows in each of label_modes (see labelEncoder).
+
+    Returns
+    -------
+    data   : (384, timeslices) input rows of the song, encoded with encode_song
+    labels : dict from label mode to its encoded labels, (1, timeslices) for
+             the single pitch modes and (16, timeslices) for multihot
+    """
+    num_notes       = pianoRoll.NUM_NOTES
+    num_instruments = pianoRoll.NUM_INSTRUMENTS
+
+    bass_roll = filtered_data[num_notes*(num_instruments-1):num_notes*num_instruments, :]
+    labels = {mode: labelEncoder.encode_labels(bass_roll, mode) for mode in label_modes}
+
+    return encode_song(filtered_data[0:num_notes*(num_instruments-1), :], packed), labels
+
+
+def column_runs(roll):
+    """
+    Find the runs of identical consecutive columns of a piano roll.
+
+    Returns
+    -------
+    run_starts  : column where each run starts, i.e. the columns kept when
+                  the roll is run-length encoded
+    run_lengths : (runs,) uint32 number of columns of each run
+    """
+    num_columns = roll.shape[1]
+    changes = np.ones(num_columns, dtype=bool)
+    changes[1:] = (roll[:, 1:] != roll[:, :-1]).any(axis=0)
+
+    run_starts  = np.flatnonzero(changes)
+    run_lengths = np.diff(np.append(run_starts, num_columns)).astype(np.uint32)
+    return run_starts, run_lengths
+
+
+def window_hashes(roll, chunk_size, chunk_step):
+    """
+    Hash every chunk of a piano roll, with chunks laid out as in chunk_index.
+    Two chunks have the same hash when all their rows, inputs and bass
+    rows (hence labels) alike, are equal.
+
+    Returns
+    -------
+    hashes : (chunks, 2) uint64 array, 128 bit blake2b digest of each chunk
+    """
+    num_chunks = int(chunk_index([roll.shape[1]], chunk_size, chunk_step)[-1])
+
+    # Time-major packed bits so the bytes of a chunk are contiguous
+    columns = np.ascontiguousarray(np.packbits(roll != 0, axis=0).T)
+    digests = b"".join(hashlib.blake2b(columns[start:start + chunk_size].tobytes(), digest_size=16).digest()
+                       for start in range(0, num_chunks * chunk_step, chunk_step))
+    return np.frombuffer(digests, dtype=np.uint64).reshape(num_chunks, 2)
+
+
+def song_digest(song):
+    """
+    Return the sha1 content hash of a song: of its source file when the
+    song has a path to an existing file, of its note arrays otherwise
+    """
+    sha1 = hashlib.sha1()
+    path = getattr(song, 'path', None)
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+    notes = pianoRoll.as_song_notes(song)
+    for array in [notes.start, notes.end, notes.pitch, notes.category]:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    return sha1.hexdigest()
+
+
+# Result of process_song for one song
+ProcessedSong = collections.namedtuple("ProcessedSong", ["digest", "path", "data", "labels", "num_columns",
+                                                         "run_lengths", "window_hashes", "timings"],
+                                       defaults=[None])
+
+
+def process_song(item, packed = False, label_modes = ("single",), run_length = False, hash_windows = False,
+                 chunk_size = 50, grid = None, timed = False):
+    """
+    Worker task of MidiToFile: rasterize and label a (digest, song) pair,
+    computing the digest if it is not known yet.
+
+    If run_length is set, only the first column of each run of identical
+    columns is kept. If hash_windows is set, the chunks of the song are
+    hashed (see window_hashes) before run-length encoding. If timed is set,
+    the time of each step is returned in timings (see instrumentation.Laps).
+
+    Returns
+    -------
+    ProcessedSong, with num_columns the number of columns before run-length
+    encoding and run_lengths / window_hashes / timings None when not computed
+    """
+    laps = Laps() if timed else None
+    digest, song = item
+    if digest is None:
+        digest = song_digest(song)
+        if laps is not None:
+            laps.lap("hash_song")
+
+    roll = sounding_roll(song, grid)
+    num_columns = roll.shape[1]
+    if laps is not None:
+        laps.lap("rasterize")
+
+    hashes = None
+    if hash_windows:
+        hashes = window_hashes(roll, chunk_size, CHUNK_INDEX_STEP)
+        if laps is not None:
+            laps.lap("hash_windows")
+
+    run_lengths = None
+    if run_length:
+        run_starts, run_lengths = column_runs(roll)
+        roll = roll[:, run_starts]
+        if laps is not None:
+            laps.lap("run_length")
+
+    data, labels = encode_roll(roll, packed, label_modes)
+    if laps is not None:
+        laps.lap("label")
+    return ProcessedSong(digest, getattr(song, 'path', None), data, labels, num_columns, run_lengths, hashes,
+                         laps.seconds if laps is not None else None)
+
+
+class NpyAppender():
+    """
+    Writes a .npy file row by row along its first axis without knowing the
+    final number of rows. The header is written with a fixed size and
+    rewritten with the final shape by close(), so the file can be read with
+    np.load(..., mmap_mode='r').
+
+    If resume_rows is given, an existing file is truncated to its first
+    resume_rows rows and appended to. A ValueError is raised if it has
+    fewer rows.
+    """
+
+    HEADER_SIZE = 128
+
+    def __init__(self, filename, row_shape, dtype, resume_rows = None):
+        self.filename  = filename
+        self.row_shape = tuple(row_shape)
+        self.dtype     = np.dtype(dtype)
+        self.num_rows  = 0
+        if resume_rows is None:
+            self.f = open(filename, 'wb')
+        else:
+            self.num_rows = resume_rows
+            size = self.HEADER_SIZE + resume_rows * int(np.prod(self.row_shape)) * self.dtype.itemsize
+            # truncate() would pad a shorter file with zeros
+            if not os.path.exists(filename) or os.path.getsize(filename) < size:
+                raise ValueError("Cannot append to %s: it holds fewer than the %d rows the manifest lists"
+                                 % (filename, resume_rows))
+            self.f = open(filename, 'r+b')
+            self.f.truncate(size)
+        self.write_header()
+
+    def write_header(self):
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(self.dtype), (self.num_rows,) + self.row_shape)
+        # magic string, version 1.0, header length, header padded with spaces and ending with a newline
+        header = header.ljust(self.HEADER_SIZE - 10 - 1) + "\n"
+        self.f.seek(0)
+        self.f.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+        self.f.seek(0, 2)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype)
+        assert rows.shape[1:] == self.row_shape
+        self.f.write(rows.tobytes())
+        self.num_rows += rows.shape[0]
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is not None:
+            self.write_header()
+            self.f.close()
+            self.f = None
+
+
+def chunk_index(song_lengths, chunk_size, chunk_step):
+    """
+    Return the chunk index of a list of songs: the number of chunks before
+    each song, with chunks of chunk_size columns starting every chunk_step
+    columns and ending before the last column of the song.
+
+    Chunk idx then belongs to song s = searchsorted(chunk_offsets, idx, 'right') - 1
+    and starts at column (idx - chunk_offsets[s]) * chunk_step of that song.
+
+    Returns
+    -------
+    chunk_offsets : (num songs + 1,) int64 array
+    """
+    song_lengths = np.asarray(song_lengths, dtype=np.int64)
+    num_chunks = np.maximum(0, (song_lengths - chunk_size + chunk_step - 1) // chunk_step)
+
+    chunk_offsets = np.zeros(len(song_lengths) + 1, dtype=np.int64)
+    chunk_offsets[1:] = np.cumsum(num_chunks)
+    return chunk_offsets
+
+
+def check_meta(saved_meta, meta, filename):
+    """
+    Raise a ValueError if an existing file was written with another layout
+    than the one of the build appending to it
+    """
+    for key, value in meta.items():
+        if key in saved_meta and saved_meta[key] != value:
+            raise ValueError("Cannot append to %s: it has %s = %r, the build uses %r"
+                             % (filename, key, saved_meta[key], value))
+
+
+class H5SongWriter():
+    """
+    Writes songs to the format 2 HDF5 layout, V3<type>V2.hdf5:
+
+    data          : (384, total timeslices) all songs concatenated along time
+    labels        : (1, total timeslices) single label of every timeslice
+    labels_<mode> : labels of every other mode in meta['label_modes'] (see labelEncoder)
+    offsets       : (num songs + 1,) first timeslice of each song in data/labels
+    run_lengths   : (total timeslices,) if meta['run_length'], number of identical
+                    columns each stored timeslice stands for (see column_runs)
+
+    The datasets are chunked along time so a window only touches one or
+    two chunks, can be compressed, and grow as songs are appended.
+
+    If song_lengths is given, the existing file is truncated to these songs
+    and appended to. A ValueError is raised if it holds fewer timeslices.
+    """
+
+    def __init__(self, data_type, meta, dtype = np.uint8, compression = None, song_lengths = None):
+        self.meta = meta
+        self.label_modes = meta['label_modes'].split(",")
+        filename = "V3" + data_type + "V2.hdf5"
+
+        if song_lengths is not None:
+            self.song_lengths = list(song_lengths)
+            self.hf = h5py.File(filename, 'r+')
+            check_meta(dict(self.hf.attrs), meta, filename)
+            self.data_ds  = self.hf['data']
+            self.label_ds = {mode: self.hf['labels' + labelEncoder.label_suffix(mode)] for mode in self.label_modes}
+            self.run_ds = self.hf['run_lengths'] if meta['run_length'] else None
+            total = int(np.sum(self.song_lengths))
+            # resize() would pad shorter datasets with zeros
+            for ds in [self.data_ds] + list(self.label_ds.values()) + [self.run_ds]:
+                if ds is not None and ds.shape[-1] < total:
+                    raise ValueError("Cannot append to %s: %s holds %d timeslices, the manifest lists %d"
+                                     % (filename, ds.name, ds.shape[-1], total))
+            self.data_ds.resize(total, axis=1)
+            for ds in self.label_ds.values():
+                ds.resize(total, axis=1)
+            if self.run_ds is not None:
+                self.run_ds.resize(total, axis=0)
+            if 'offsets' in self.hf:
+                del self.hf['offsets']
+            return
+
+        self.song_lengths = []
+        self.hf = h5py.File(filename, 'w')
+
+        num_stored_rows = (NUM_SONG_ROWS + 7) // 8 if meta['packed'] else NUM_SONG_ROWS
+        self.data_ds  = self.hf.create_dataset('data', shape=(num_stored_rows, 0), maxshape=(num_stored_rows, None),
+                                               dtype=np.uint8 if meta['packed'] else dtype,
+                                               chunks=(num_stored_rows, 1024), compression=compression)
+        self.label_ds = {}
+        for mode in self.label_modes:
+            num_label_rows = labelEncoder.label_rows(mode)
+            self.label_ds[mode] = self.hf.create_dataset('labels' + labelEncoder.label_suffix(mode),
+                                                         shape=(num_label_rows, 0), maxshape=(num_label_rows, None),
+                                                         dtype=np.uint8, chunks=(num_label_rows, 1024),
+                                                         compression=compression)
+        self.run_ds = None
+        if meta['run_length']:
+            self.run_ds = self.hf.create_dataset('run_lengths', shape=(0,), maxshape=(None,), dtype=np.uint32,
+                                                 chunks=(4096,))
+        # Written now so a resumed build can check them
+        self.hf.attrs['format_version'] = 2
+        for key, value in self.meta.items():
+            self.hf.attrs[key] = value
+
+    def append(self, data, labels, run_lengths = None):
+        start = self.data_ds.shape[1]
+        end   = start + data.shape[1]
+        self.data_ds.resize(end, axis=1)
+        self.data_ds[:, start:end] = data
+        for mode, ds in self.label_ds.items():
+            ds.resize(end, axis=1)
+            ds[:, start:end] = labels[mode]
+        if self.run_ds is not None:
+            self.run_ds.resize(end, axis=0)
+            self.run_ds[start:end] = run_lengths
+        self.song_lengths.append(data.shape[1])
+
+    def flush(self):
+        self.hf.flush()
+
+    def close(self):
+        offsets = np.zeros(len(self.song_lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.song_lengths)
+        self.hf.create_dataset('offsets', data=offsets)
+
+        self.hf.attrs['format_version'] = 2
+        for key, value in self.meta.items():
+            self.hf.attrs[key] = value
+        self.hf.close()
+
+
+class H5SongWriterV1():
+    """
+    Writes songs to the format 1 HDF5 layout: one dataset per song, named
+    after the song index, in V3<type>.hdf5 and V3<type>Labels.hdf5.
+
+    If song_lengths is given, the existing files are truncated to these
+    songs and appended to. A ValueError is raised if they do not hold these
+    songs.
+    """
+
+    def __init__(self, data_type, meta, song_lengths = None):
+        if meta['label_modes'] != "single":
+            raise ValueError("Format 1 only stores single labels, got label modes %s" % meta['label_modes'])
+        if meta['run_length']:
+            raise ValueError("Format 1 does not support run-length encoding")
+        if pianoRoll.TimeGrid.from_meta(meta) != pianoRoll.DEFAULT_GRID:
+            raise ValueError("Format 1 does not record the grid, it only stores %r" % pianoRoll.DEFAULT_GRID)
+        mode = 'w' if song_lengths is None else 'r+'
+        self.song_lengths = [] if song_lengths is None else list(song_lengths)
+        self.hf        = h5py.File("V3" + data_type + '.hdf5', mode)
+        self.hf_labels = h5py.File("V3" + data_type + "Labels.hdf5", mode)
+
+        for idx, length in enumerate(self.song_lengths):
+            for hf in [self.hf, self.hf_labels]:
+                if str(idx) not in hf or hf[str(idx)].shape[1] != length:
+                    raise ValueError("Cannot append to %s: song %d does not match the manifest" % (hf.filename, idx))
+
+        # Songs written after the last completed one
+        for hf in [self.hf, self.hf_labels]:
+            for name in list(hf.keys()):
+                if int(name) >= len(self.song_lengths):
+                    del hf[name]
+
+    def append(self, data, labels, run_lengths = None):
+        idx = str(len(self.song_lengths))
+        self.hf.create_dataset(idx, data=data)
+        self.hf_labels.create_dataset(idx, data=labels['single'])
+        self.song_lengths.append(data.shape[1])
+
+    def flush(self):
+        self.hf.flush()
+        self.hf_labels.flush()
+
+    def close(self):
+        self.hf.close()
+        self.hf_labels.close()
+
+
+class NpySongWriter():
+    """
+    Writes songs to flat .npy files, stored time-major so a window is a
+    contiguous block of rows:
+
+    V3<type>Data.npy    : (total timeslices, 384) all songs concatenated
+    V3<type>Labels.npy  : (total timeslices, 1) single label of every timeslice
+    V3<type>Labels_<mode>.npy : labels of every other mode in meta['label_modes']
+    V3<type>Offsets.npy : (num songs + 1,) first timeslice of each song
+    V3<type>RunLengths.npy : (total timeslices,) if meta['run_length'], number of
+                          identical columns each stored timeslice stands for
+    V3<type>Meta.json   : layout of the data
+
+    If song_lengths is given, the existing files are truncated to these
+    songs and appended to. A ValueError is raised if they hold fewer
+    timeslices.
+    """
+
+    def __init__(self, data_type, meta, dtype = np.uint8, song_lengths = None):
+        self.data_type = data_type
+        self.meta = meta
+        self.label_modes = meta['label_modes'].split(",")
+        self.song_lengths = [] if song_lengths is None else list(song_lengths)
+
+        resume_rows = None
+        if song_lengths is not None:
+            with open("V3" + data_type + "Meta.json") as jf:
+                check_meta(json.load(jf), meta, "V3" + data_type + "Meta.json")
+            resume_rows = int(np.sum(self.song_lengths))
+        else:
+            # Written now so a resumed build can check it
+            with open("V3" + self.data_type + "Meta.json", "w") as jf:
+                json.dump(self.meta, jf)
+
+        num_stored_rows = (NUM_SONG_ROWS + 7) // 8 if meta['packed'] else NUM_SONG_ROWS
+        self.data_file  = NpyAppender("V3" + data_type + "Data.npy", (num_stored_rows,),
+                                      np.uint8 if meta['packed'] else dtype, resume_rows)
+        self.label_file = {mode: NpyAppender("V3" + data_type + "Labels" + labelEncoder.label_suffix(mode) + ".npy",
+                                             (labelEncoder.label_rows(mode),), np.uint8, resume_rows)
+                           for mode in self.label_modes}
+        self.run_file = None
+        if meta['run_length']:
+            self.run_file = NpyAppender("V3" + data_type + "RunLengths.npy", (), np.uint32, resume_rows)
+
+    def append(self, data, labels, run_lengths = None):
+        self.data_file.append(data.T)
+        for mode, f in self.label_file.items():
+            f.append(labels[mode].T)
+        if self.run_file is not None:
+            self.run_file.append(run_lengths)
+        self.song_lengths.append(data.shape[1])
+
+    def flush(self):
+        self.data_file.flush()
+        for f in self.label_file.values():
+            f.flush()
+        if self.run_file is not None:
+            self.run_file.flush()
+
+    def close(self):
+        self.data_file.close()
+        for f in self.label_file.values():
+            f.close()
+        if self.run_file is not None:
+            self.run_file.close()
+
+        offsets = np.zeros(len(self.song_lengths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.song_lengths)
+        np.save("V3" + self.data_type + "Offsets.npy", offsets)
+        with open("V3" + self.data_type + "Meta.json", "w") as jf:
+            json.dump(self.meta, jf)
+
 
 class MidiToFile(Dataset):
     """MIDI dataset."""
 
-    def __init__(self, data, data_type = "train"):
+    def __init__(self, data, data_type = "train", format_version = FORMAT_VERSION, dtype = np.uint8, compression = None,
+                 backend = "hdf5", packed = False, n_jobs = None, max_pending = None, mode = "w",
+                 label_modes = ("single",), run_length = False, dedup = None, grid = None):
         """
-        Args:None 
+        Args:
+            data           : series or iterable of songs (PrettyMIDI objects or SongNotes)
+            data_type      : "train", "val" or "test"
+            format_version : 1 writes one dataset per song in V3<type>.hdf5 and
+                             V3<type>Labels.hdf5, 2 writes all songs to a single
+                             dataset in V3<type>V2.hdf5 (see H5SongWriter)
+            dtype          : dtype of the song data in format 2 and npy
+            compression    : h5py compression filter of format 2 ("gzip", "lzf" or None)
+            backend        : "hdf5" writes the HDF5 layout given by format_version,
+                             "npy" writes flat .npy files that MidiSavedDataset
+                             memory-maps (see NpySongWriter)
+            packed         : store the song data with 1 bit per cell, packed
+                             along the pitch axis with np.packbits (format 2
+                             and npy only)
+            n_jobs         : number of worker processes rasterizing and labelling
+                             songs (number of cores if None, none if 1)
+            max_pending    : maximum number of songs handed to the workers and
+                             not yet written, which bounds memory (2 * n_jobs if None)
+            mode           : "w" builds the split from scratch, "a" appends to the
+                             existing files: songs already listed in the manifest
+                             are skipped and an interrupted build is resumed
+                             after its last completed song (see read_manifest).
+                             Raises a ValueError if the manifest was written by
+                             another backend or format, or lists more data than
+                             the files hold
+            label_modes    : label encodings to store besides the single labels:
+                             "lowest" and/or "multihot" (see labelEncoder).
+                             MidiSavedDataset can then return any of them, and
+                             "highest" labels, which are the single labels
+            run_length     : store each run of identical consecutive columns (held
+                             chords) once, with its length (format 2 and npy only,
+                             see column_runs). MidiSavedDataset expands the runs
+            dedup          : None keeps every chunk, "drop" keeps only the first of
+                             the chunks with identical content in the split, "weight"
+                             does the same and saves the number of copies of each
+                             kept chunk (see deduplicate_chunks)
+            grid           : pianoRoll.TimeGrid of the columns, 10 ms timeslices if
+                             None. TimeGrid(beat_subdivisions=4) gives 4 columns per
+                             beat, following the tempo of each song
         """
         self.data_type = data_type
+        self.format_version = format_version
+        self.dtype = dtype
+        self.compression = compression
+        self.backend = backend
+        # Format 1 stores every song in its own dataset, unpacked
+        if packed and backend == "hdf5" and format_version == 1:
+            raise ValueError("Format 1 does not support packed data, use format_version=2 or backend='npy'")
+        self.packed = packed
+        self.mode = mode
+        self.label_modes = labelEncoder.stored_label_modes(label_modes)
+        self.run_length = run_length
+        if dedup not in [None, "drop", "weight"]:
+            raise ValueError("dedup must be None, 'drop' or 'weight', got %r" % dedup)
+        self.dedup = dedup
+        self.grid = grid if grid is not None else pianoRoll.DEFAULT_GRID
         self.dataset_name = data_type
         self.all_songs_df = data
 
-        self.list_of_songs       = []
-        self.label_list_of_songs = []
+        self.n_jobs      = n_jobs if n_jobs is not None else (os.cpu_count() or 1)
+        self.max_pending = max_pending if max_pending is not None else 2 * self.n_jobs
         
         self.chunk_step_size = 1
         self.chunk_size = 50
@@ -34,135 +565,230 @@ class MidiToFile(Dataset):
             self.chunk_step_size = 10
             
         self.length = 0
+
+        # Number of chunks before each song, see chunk_index
+        self.chunk_offsets = None
+
+        # Number of songs, time and throughput of the build
+        self.report = {}
+
+        # One json line per song written so far: path, content hash, length and
+        # the layout of the files it was written to (shared by every backend)
+        self.manifest_name = "V3" + data_type + "Manifest.jsonl"
+        self.layout = {'backend': backend, 'format_version': format_version if backend == "hdf5" else None}
+        if self.mode not in ["w", "a"]:
+            raise ValueError("mode must be 'w' or 'a', got %r" % mode)
+        # Without a manifest there is nothing to append to
+        resume = self.mode == "a" and os.path.exists(self.manifest_name)
+        manifest = self.read_manifest() if resume else []
+        for entry in manifest:
+            layout = {key: entry.get(key, value) for key, value in self.layout.items()}
+            if layout != self.layout:
+                raise ValueError("Cannot append to %s: its songs were written with %s, the build uses %s"
+                                 % (self.manifest_name, layout, self.layout))
+        # Songs written by previous builds, skipped when appending. Songs of this
+        # build are all written, even if their content repeats
+        self.known_digests = set(entry['sha1'] for entry in manifest)
+        self.skipped_songs = 0
             
-        self.dict_of_where_to_look = {}
-        
-        filename = "V3" + data_type + '.hdf5'
-        filename_labels = "V3" + data_type + "Labels.hdf5"
-            
-        self.construct_list_of_songs()
-        
-        print("List of songs length: ", len(self.list_of_songs))
-        print("List of labels length: ", len(self.label_list_of_songs))
-        
-        with h5py.File(filename, 'w') as hf:
-            self.save_data(hf, self.list_of_songs)
-        
-        with h5py.File(filename_labels, 'w') as hf: 
-            self.save_data(hf, self.label_list_of_songs)
+        # Number of columns of each song, and of stored columns when they are run-length encoded
+        self.song_columns = [entry['length'] for entry in manifest]
+        writer = self.open_writer([entry.get('stored_length', entry['length']) for entry in manifest] if resume else None)
+        num_existing = len(writer.song_lengths)
+
+        # Chunk selection of a previous build no longer matches the data
+        for name in ["Chunks.npy", "ChunkWeights.npy"] + ([] if self.dedup else ["WindowHashes.npy"]):
+            if os.path.exists("V3" + data_type + name):
+                os.remove("V3" + data_type + name)
+        hash_file = self.open_hash_file(resume) if self.dedup else None
+
+        t0 = time.perf_counter()
+        with open(self.manifest_name, "a" if resume else "w") as mf:
+            for song in self.iter_processed_songs():
+                if song.timings is not None:
+                    for name, step_seconds in song.timings.items():
+                        pipeline.record(name, step_seconds)
+                if song.digest in self.known_digests:
+                    self.skipped_songs += 1
+                    continue
+                with pipeline.stage("write"):
+                    writer.append(song.data, song.labels, song.run_lengths)
+                    writer.flush()
+                    if hash_file is not None:
+                        hash_file.append(song.window_hashes)
+                        hash_file.flush()
+
+                    # The song only counts as written once it is in the manifest
+                    self.song_columns.append(song.num_columns)
+                    entry = {'path': song.path, 'sha1': song.digest, 'length': int(song.num_columns)}
+                    entry.update(self.layout)
+                    if self.run_length:
+                        entry['stored_length'] = int(song.data.shape[1])
+                    mf.write(json.dumps(entry) + "\n")
+                    mf.flush()
+                    os.fsync(mf.fileno())
+
+                num_written = len(writer.song_lengths) - num_existing
+                if num_written % 100 == 0:
+                    print("Song index: ", num_written - 1, ", Songs per second: %.1f" % (num_written/(time.perf_counter() - t0)))
+        writer.close()
+        if hash_file is not None:
+            hash_file.close()
+        seconds = time.perf_counter() - t0
+
+        self.build_chunk_index(self.song_columns)
              
-        picklename = "V3" + data_type + "Other.pkl"
-        with open(picklename, "wb") as pf:
-            pkl.dump((self.length, self.dict_of_where_to_look), pf)
+        # Saved as .npy so MidiSavedDataset can memory-map it
+        indexname = "V3" + data_type + "Index.npy"
+        np.save(indexname, self.chunk_offsets)
+
+        self.unique_chunks = self.length
+        if self.dedup:
+            self.deduplicate_chunks()
+
+        num_songs = len(writer.song_lengths) - num_existing
+        self.report = {'songs': num_songs,
+                       'existing_songs': num_existing,
+                       'skipped_songs': self.skipped_songs,
+                       'seconds': seconds,
+                       'songs_per_second': num_songs/seconds if seconds > 0 else 0.0,
+                       'chunks': self.length,
+                       'unique_chunks': self.unique_chunks,
+                       'columns': int(np.sum(self.song_columns)),
+                       'stored_columns': int(np.sum(writer.song_lengths))}
+        print("Songs: ", num_songs, ", Existing: ", num_existing, ", Skipped: ", self.skipped_songs,
+              ", Songs per second: %.1f" % self.report['songs_per_second'], ", Num chunks: ", self.length)
+        if self.run_length or self.dedup:
+            print("Columns: ", self.report['columns'], ", Stored columns: ", self.report['stored_columns'],
+                  "(%.1fx smaller)" % (self.report['columns']/max(1, self.report['stored_columns'])),
+                  ", Unique chunks: ", self.unique_chunks,
+                  "(%.1f%% duplicates)" % (100.0 * (1 - self.unique_chunks/self.length) if self.length > 0 else 0.0))
            
  
-    def instrument_to_index(self, instrument):
+    def read_manifest(self): 
         """
-        Return the index of the category the instrument belongs to 
-        
-        Parameters
-        ----------
-        Instrument : instrument program number
-
-        Returns
-        -------
-        0  : instrument program number is in the piano category 
-        1  : instrument program number is in the guitar category
-        2  : instrument program number is in the string category
-        3  : instrument program number is in the bass category
-        -1 : instrument program number is not in our of the four desired categories
-        """
-        piano_program_numbers  = set([0, 1, 2, 3, 4])
-        guitar_program_numbers = set([25, 26, 27, 28, 29])
-        bass_program_numbers   = set([33, 34, 35, 36, 37, 38, 52])
-        string_program_numbers = set([41, 42, 43, 49, 50, 51])
-
-        if instrument in piano_program_numbers:
-            return 0
-        elif instrument in guitar_program_numbers:
-            return 1
-        elif instrument in string_program_numbers:
-            return 2 
-        elif instrument in bass_program_numbers:
-            return 3
-        else:
-            return -1
-        
-    def construct_list_of_songs(self):
+        Return the manifest entries of the songs completely written by
+        previous builds, dropping a partially written last line, and
+        rewrite the manifest with only these entries.
         """
-        Import an array of midi files and output a list of songs 
-        where each song is composed of a list of chunks and each 
-        chunk is a numpy array. 
+        manifest = []
+        with open(self.manifest_name) as mf:
+            for line in mf:
+                try:
+                    manifest.append(json.loads(line))
+                except ValueError:
+                    break
 
+        with open(self.manifest_name, "w") as mf:
+            for entry in manifest:
+                mf.write(json.dumps(entry) + "\n")
+        return manifest
+
+    def open_writer(self, song_lengths = None): 
         """
-        T = 0.010   # Timestep (s)
-        chunk_size      = 50
-        chunk_offset    = self.chunk_step_size
-        num_notes       = 128
-        num_instruments = 4
-        
-        # Iterate through every midi and extract chunks in each song 
-        for idx, row in self.all_songs_df.items():
-            t_end = row.get_end_time()
-            num_timeslices = int(t_end/T)
+        Return the writer of the selected backend and layout, appending
+        after the songs of song_lengths if given
+        """
+        meta = {'chunk_size': self.chunk_size,
+                'chunk_step': CHUNK_INDEX_STEP,
+                'min_pitch': 0,
+                'max_pitch': pianoRoll.NUM_NOTES - 1,
+                'packed': bool(self.packed),
+                'num_rows': NUM_SONG_ROWS,
+                'label_modes': ",".join(self.label_modes),
+                'run_length': bool(self.run_length)}
+        # Resolution of the columns: 'grid', 'T' and 'beat_subdivisions'
+        meta.update(self.grid.meta())
 
-            # Create data array to store all of the notes in the song based on the timestep they are played in 
-            data = np.zeros((num_notes * num_instruments, num_timeslices)) 
-            
-            for instrument in row.instruments:
-                index = self.instrument_to_index(instrument.program)
-                if (index != -1):
-                    for note in instrument.notes:
-                        data[num_notes * index + note.pitch, math.floor(note.start/T):math.floor(note.end/T)] = 1  
-                        
-#             self.list_of_songs.append(data[0:num_notes*(num_instruments-1), :])
-#             self.label_list_of_songs.append(data[num_notes*(num_instruments-1):num_notes*num_instruments, :])
-                        
-            filtered_data = data[:,~(data==0).all(axis=0)]
-        
-#             print("Data: ", data.shape)
-#             print("Filter: ", filtered_data.shape)
-
-            y_pos_labels = np.argwhere(filtered_data[num_notes*(num_instruments-1):num_notes*num_instruments, :]>0)
-            single_label_data = np.zeros((1,filtered_data.shape[1]))
-            single_label_data.fill(128)
-            for element in y_pos_labels: 
-                single_label_data[0,element[1]] = element[0] 
-            
-            self.list_of_songs.append(filtered_data[0:num_notes*(num_instruments-1), :])
-            self.label_list_of_songs.append(single_label_data)
-        
-            
-            
-#             self.list_of_songs.append(filtered_data[0:num_notes*(num_instruments-1), :])
-#             self.label_list_of_songs.append(filtered_data[num_notes*(num_instruments-1):num_notes*num_instruments, :])
-        
+        if self.backend == "npy":
+            return NpySongWriter(self.data_type, meta, self.dtype, song_lengths)
+        elif self.format_version == 1:
+            return H5SongWriterV1(self.data_type, meta, song_lengths)
+        return H5SongWriter(self.data_type, meta, self.dtype, self.compression, song_lengths)
+
+    def iter_processed_songs(self): 
+        """
+        Rasterize and label the songs in a pool of n_jobs worker processes
+        and yield the ProcessedSong of each song in order as
+        soon as it is ready (see process_song). At most max_pending songs
+        are in the workers or waiting to be written at any time.
+
+        When appending, songs with a source file are hashed here and skipped
+        before rasterization if they are already written (see iter_new_songs).
+        """
+        process = functools.partial(process_song, packed=self.packed, label_modes=self.label_modes,
+                                    run_length=self.run_length, hash_windows=bool(self.dedup),
+                                    chunk_size=self.chunk_size, grid=self.grid, timed=pipeline.enabled)
+        songs = self.iter_new_songs()
+
+        if self.n_jobs <= 1:
+            for item in songs:
+                yield process(item)
+            return
+
+        # Songs are handed to the pool from this thread, so a failing song, a
+        # failing write or Ctrl-C propagates here and the pool is terminated
+        with multiprocessing.Pool(self.n_jobs) as pool:
+            pending = collections.deque()
+            for item in songs:
+                pending.append(pool.apply_async(process, (item,)))
+                if len(pending) >= self.max_pending:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
             
-    def save_data(self,hf, list_of_items): 
-        print("Length of list: ", len(list_of_items))
-        chunk_idx = 0
-        for idx, song in enumerate(list_of_items):
-            for chunk in range(0, song.shape[1]-self.chunk_size, 10):
-                self.dict_of_where_to_look[chunk_idx] = (idx, (chunk, chunk+self.chunk_size))
-#                 print("Song: ", idx, ", Chunk 0: ", chunk, ", Chunk 1: ", chunk + self.chunk_size)
-                chunk_idx += 1
-            self.write_song_to_h5(str(idx), song, hf)
-#             print("Song index: ", idx, ", Shape: ", song.shape)
-
-        self.length = chunk_idx
-        print("Num chunks: ", self.length)
+    def iter_new_songs(self): 
+        """
+        Yield (digest, song) for the songs to process. When appending,
+        songs with a source file are hashed here to skip the written ones
+        before rasterization; otherwise the digest is left to the workers
+        """
+        for song in pianoRoll.iter_songs(self.all_songs_df):
+            digest = None
+            path = getattr(song, 'path', None)
+            if self.known_digests and path is not None and os.path.exists(path):
+                with pipeline.stage("hash_song"):
+                    digest = song_digest(song)
+                if digest in self.known_digests:
+                    self.skipped_songs += 1
+                    continue
+            yield digest, song
             
-    def write_song_to_h5(self, idx, song, hf): 
-        # idx corresponds to the song index written as a string
-#         import pdb; pdb.set_trace()
-        hf.create_dataset(idx, data=song)
-    
-    def save_dict(self, hf):
-        hf.create_dataset('Dict', data=self.dict_of_where_to_look)
-        
-    def save_length(self, hf): 
-        hf.create_dataset('Length', data=self.length)
-                       
+    def open_hash_file(self, resume):
+        """
+        Open the file of chunk hashes used by deduplicate_chunks, keeping the
+        hashes of the songs already written when resuming
+        """
+        filename = "V3" + self.data_type + "WindowHashes.npy"
+        resume_rows = None
+        if resume:
+            if not os.path.exists(filename) and len(self.song_columns) > 0:
+                raise ValueError("Cannot deduplicate while appending to %s: it was built without dedup"
+                                 % self.manifest_name)
+            if os.path.exists(filename):
+                resume_rows = int(chunk_index(self.song_columns, self.chunk_size, CHUNK_INDEX_STEP)[-1])
+        return NpyAppender(filename, (2,), np.uint64, resume_rows)
+
+    def deduplicate_chunks(self):
+        """
+        Keep the first chunk of each group of chunks with the same hash
+        (see window_hashes) and save the indices of the kept chunks to
+        V3<type>Chunks.npy. With dedup="weight", the number of chunks of
+        each group is saved to V3<type>ChunkWeights.npy, so sampling or
+        weighting by it gives the same distribution as the full split.
+        """
+        hashes = np.load("V3" + self.data_type + "WindowHashes.npy", mmap_mode='r')
+        _, first, inverse, counts = np.unique(hashes, axis=0, return_index=True, return_inverse=True,
+                                              return_counts=True)
+        kept = np.sort(first)
+        np.save("V3" + self.data_type + "Chunks.npy", kept.astype(np.int64))
+        if self.dedup == "weight":
+            np.save("V3" + self.data_type + "ChunkWeights.npy", counts[inverse.reshape(-1)[kept]].astype(np.float32))
+        self.unique_chunks = len(kept)
 
-    
-    
\ No newline at end of file
+    def build_chunk_index(self, song_lengths): 
+        """
+        Compute the chunk offsets of the songs (see chunk_index).
+        """
+        self.chunk_offsets = chunk_index(song_lengths, self.chunk_size, CHUNK_INDEX_STEP)
+        self.length = int(self.chunk_offsets[-1])
@@ -0,0 +1,232 @@
+import numpy as np
+
+import torch
+
+import pianoRoll
+
+
+def as_numpy(x):
+    """
+    Return a numpy array of a tensor (on any device) or array-like
+    """
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+
+def metrics_from_counts(tp, fp, fn, tn):
+    """
+    Compute accuracy, precision, recall and F1 from confusion counts of
+    any shape, element-wise.
+
+    Precision is 1 where nothing is predicted positive, as in the notebooks'
+    evaluate_metrics. Recall and F1 are nan where there is no positive label.
+
+    Returns
+    -------
+    dict of accuracy, precision, recall and f1 arrays of the shape of the counts
+    """
+    tp, fp, fn, tn = [np.asarray(c, dtype=np.float64) for c in (tp, fp, fn, tn)]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        accuracy  = (tp + tn)/(tp + fp + fn + tn)
+        precision = np.where(tp + fp > 0, tp/(tp + fp), 1.0)
+        recall    = np.where(tp + fn > 0, tp/(tp + fn), np.nan)
+        f1        = np.where(precision + recall > 0, 2 * precision * recall/(precision + recall), 0.0)
+    f1 = np.where(np.isnan(recall), np.nan, f1)
+    return {'accuracy': accuracy, 'precision': precision, 'recall': recall, 'f1': f1}
+
+
+def evaluate_metrics(preds, labels):
+    """
+    Vectorized version of the notebooks' evaluate_metrics for multi-hot
+    predictions: accuracy over every (timestep, note) cell, recall and
+    precision of the 1 cells.
+
+    Parameters
+    ----------
+    preds  : (timesteps, 128) array of 0/1 predictions
+    labels : (timesteps, 128) array of 0/1 labels
+
+    Returns
+    -------
+    accuracy, recall, precision
+    """
+    preds  = as_numpy(preds) == 1
+    labels = as_numpy(labels) == 1
+    tp = np.count_nonzero(preds & labels)
+    fp = np.count_nonzero(preds & ~labels)
+    fn = np.count_nonzero(~preds & labels)
+    tn = preds.size - tp - fp - fn
+    metrics = metrics_from_counts(tp, fp, fn, tn)
+    return float(metrics['accuracy']), float(metrics['recall']), float(metrics['precision'])
+
+
+class MultiLabelMetrics():
+    """
+    Per-pitch confusion counts of multi-hot predictions (sigmoid outputs of
+    the BCE models) at many thresholds at once, accumulated batch by batch.
+
+    A cell is predicted playing at threshold t if its probability is >= t,
+    as with PLAYING_THRESH in the notebooks. Instead of one comparison per
+    threshold, each probability is binned between the sorted thresholds and
+    the bin counts of positive and negative labels are accumulated per
+    pitch. The counts at every threshold are cumulative sums of the bins, so
+    an update costs the same for 1 or 1000 thresholds.
+    """
+
+    def __init__(self, thresholds = None, num_labels = pianoRoll.NUM_NOTES):
+        """
+        Args:
+            thresholds : increasing thresholds to evaluate, 0.01 to 0.99 by 0.01 if None
+            num_labels : number of label columns (pitches)
+        """
+        if thresholds is None:
+            thresholds = np.linspace(0.01, 0.99, 99)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        if np.any(np.diff(self.thresholds) <= 0):
+            raise ValueError("Thresholds must be increasing")
+        self.num_labels = num_labels
+        self.reset()
+
+    def reset(self):
+        # Number of cells of each pitch with k thresholds <= their probability, by label
+        num_bins = len(self.thresholds) + 1
+        self.positive_bins = np.zeros((num_bins, self.num_labels), dtype=np.int64)
+        self.negative_bins = np.zeros((num_bins, self.num_labels), dtype=np.int64)
+
+    def update(self, probs, labels):
+        """
+        Add a batch
+
+        Parameters
+        ----------
+        probs  : (batch, num_labels) tensor or array of probabilities
+        labels : (batch, num_labels) tensor or array of 0/1 labels
+        """
+        probs  = as_numpy(probs).reshape(-1, self.num_labels)
+        labels = as_numpy(labels).reshape(-1, self.num_labels) == 1
+
+        num_bins = len(self.thresholds) + 1
+        bins  = np.searchsorted(self.thresholds, probs, side="right")
+        cells = bins * self.num_labels + np.arange(self.num_labels)
+        self.positive_bins += np.bincount(cells[labels], minlength=num_bins * self.num_labels).reshape(num_bins, -1)
+        self.negative_bins += np.bincount(cells[~labels], minlength=num_bins * self.num_labels).reshape(num_bins, -1)
+
+    def counts(self):
+        """
+        Return the per-pitch confusion counts at every threshold
+
+        Returns
+        -------
+        tp, fp, fn, tn : (num_thresholds, num_labels) arrays
+        """
+        # Cells predicted positive at threshold k are those of bins k + 1 and above
+        tp = np.cumsum(self.positive_bins[::-1], axis=0)[::-1][1:]
+        fp = np.cumsum(self.negative_bins[::-1], axis=0)[::-1][1:]
+        fn = self.positive_bins.sum(axis=0) - tp
+        tn = self.negative_bins.sum(axis=0) - fp
+        return tp, fp, fn, tn
+
+    def compute(self):
+        """
+        Return the metrics at every threshold
+
+        Returns
+        -------
+        dict of
+            thresholds                         : (num_thresholds,) array
+            accuracy, precision, recall, f1    : (num_thresholds, num_labels) arrays, per pitch
+            total_accuracy, total_precision,
+            total_recall, total_f1             : (num_thresholds,) arrays over every
+                                                 cell, as evaluate_metrics computes them
+        """
+        tp, fp, fn, tn = self.counts()
+        metrics = metrics_from_counts(tp, fp, fn, tn)
+        totals  = metrics_from_counts(tp.sum(axis=1), fp.sum(axis=1), fn.sum(axis=1), tn.sum(axis=1))
+        for name, values in totals.items():
+            metrics['total_' + name] = values
+        metrics['thresholds'] = self.thresholds
+        return metrics
+
+    def best_threshold(self, metric = "total_f1"):
+        """
+        Return the threshold maximizing a metric over every cell, and the value of the metric
+        """
+        values = self.compute()[metric]
+        best = int(np.nanargmax(values))
+        return float(self.thresholds[best]), float(values[best])
+
+
+class SingleLabelMetrics():
+    """
+    Confusion matrix of single label predictions (the 129-way output of Net,
+    128 for no note), accumulated batch by batch, with per-pitch precision,
+    recall and F1 (one pitch against the rest).
+    """
+
+    def __init__(self, num_classes = pianoRoll.NUM_NOTES + 1):
+        self.num_classes = num_classes
+        self.reset()
+
+    def reset(self):
+        # confusion[label, prediction]
+        self.confusion = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+
+    def update(self, outputs, labels):
+        """
+        Add a batch
+
+        Parameters
+        ----------
+        outputs : (batch, num_classes) logits or probabilities, or (batch,) predicted classes
+        labels  : (batch,) classes
+        """
+        outputs = as_numpy(outputs)
+        preds  = outputs.argmax(axis=1) if outputs.ndim == 2 else outputs
+        labels = as_numpy(labels).reshape(-1).astype(np.int64)
+        cells  = labels * self.num_classes + preds.astype(np.int64)
+        self.confusion += np.bincount(cells, minlength=self.num_classes ** 2).reshape(self.num_classes, -1)
+
+    def compute(self):
+        """
+        Returns
+        -------
+        dict of
+            accuracy                           : fraction of correct predictions
+            precision, recall, f1, support     : (num_classes,) arrays, per class
+            macro_f1                           : mean F1 of the classes with labels
+        """
+        total = self.confusion.sum()
+        tp = np.diag(self.confusion)
+        fp = self.confusion.sum(axis=0) - tp
+        fn = self.confusion.sum(axis=1) - tp
+        metrics = metrics_from_counts(tp, fp, fn, total - tp - fp - fn)
+        metrics['accuracy'] = tp.sum()/total if total > 0 else np.nan
+        metrics['support']  = tp + fn
+        metrics['macro_f1'] = np.nanmean(metrics['f1']) if np.any(tp + fn > 0) else np.nan
+        return metrics
+
+
+def evaluate_loader(net, loader, metrics, multihot = False):
+    """
+    Run net on every batch of a DataLoader and add its outputs to metrics
+
+    Parameters
+    ----------
+    net      : network, its outputs are logits
+    loader   : DataLoader of (inputs, labels) batches
+    metrics  : SingleLabelMetrics, or MultiLabelMetrics with multihot=True
+    multihot : apply a sigmoid to the outputs (BCE models)
+
+    Returns
+    -------
+    metrics.compute()
+    """
+    net.eval()
+    with torch.no_grad():
+        for inputs, labels in loader:
+            outputs = net(inputs)
+            if multihot:
+                outputs = torch.sigmoid(outputs)
+            metrics.update(outputs, labels)
+    return metrics.compute()
@@ -0,0 +1,153 @@
+import numpy as np
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from comparePrecision import saved_chunks, synthetic_chunks, train
+from models import Net
+from servingModel import ServedModel
+
+
+def quantize_fc(net):
+    """
+    Return a copy of a float32 Net with fc1, fc2 and fc3 dynamically
+    quantized to int8 (weights stored as int8, activations quantized on the
+    fly). The convolutions stay in float32.
+    """
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(net).float().eval(), {nn.Linear},
+                                                  dtype=torch.qint8)
+
+
+def export_torchscript(net, filename, quantized = False):
+    """
+    Script, freeze and save a Net for servingModel.ServedModel.
+
+    Parameters
+    ----------
+    net       : trained Net, in any precision
+    filename  : TorchScript file to write
+    quantized : quantize the fc layers to int8 first
+
+    Returns
+    -------
+    meta : dict of the metadata saved with the model
+    """
+    net = copy.deepcopy(net).float().eval()
+    if quantized:
+        net = quantize_fc(net)
+    # Freezing inlines the weights as constants, forward_song must be kept explicitly
+    module = torch.jit.freeze(torch.jit.script(net), preserved_attrs=["forward_song"])
+    meta = {'window_size': net.window_size,
+            'input_rows': net.conv1.in_channels,
+            'outputs': net.fc3.out_features,
+            'dtype': "float32",
+            'quantized': quantized,
+            'torch': torch.__version__}
+    torch.jit.save(module, filename, _extra_files={'meta.json': json.dumps(meta)})
+    return meta
+
+
+def latency_ms(fn, chunk, repeats):
+    """
+    Return the median and 99th percentile time of single chunk calls (ms)
+    """
+    fn(chunk)
+    times = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn(chunk)
+        times.append(time.perf_counter() - t0)
+    return 1000 * float(np.median(times)), 1000 * float(np.percentile(times, 99))
+
+
+def throughput(fn, data, batch_size):
+    """
+    Return the number of chunks per second of batched calls on data
+    """
+    fn(data[:batch_size])
+    t0 = time.perf_counter()
+    for start in range(0, len(data), batch_size):
+        fn(data[start:start + batch_size])
+    return len(data)/(time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Net to TorchScript, float32 and with int8 fc layers, "
+                                                 "and compare their latency, throughput and accuracy with the "
+                                                 "eager float model")
+    parser.add_argument("--state-dict", default=None, help="weights saved with torch.save(net.state_dict(), PATH); "
+                                                           "without it a Net is trained for --train-steps")
+    parser.add_argument("--output-dir", default="export")
+    parser.add_argument("--data-type", default=None, help="evaluate on this MidiToFile split of the working "
+                                                          "directory instead of synthetic songs")
+    parser.add_argument("--backend", default="hdf5", choices=["hdf5", "npy"])
+    parser.add_argument("--num-songs", type=int, default=10, help="number of synthetic songs")
+    parser.add_argument("--max-chunks", type=int, default=20000)
+    parser.add_argument("--train-steps", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=256, help="batch size of the throughput measure")
+    parser.add_argument("--repeats", type=int, default=500, help="number of calls of the latency measure")
+    parser.add_argument("--num-threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="export.json", help="JSON file of the report")
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    if args.data_type is not None:
+        data, labels = saved_chunks(args.data_type, args.backend, args.max_chunks, args.seed)
+    else:
+        data, labels = synthetic_chunks(args.num_songs, args.seed)
+        data, labels = data[:args.max_chunks], labels[:args.max_chunks]
+
+    net = Net().float()
+    if args.state_dict is not None:
+        net.load_state_dict(torch.load(args.state_dict, map_location="cpu"))
+    else:
+        num_train = int(0.8 * len(data))
+        train(net, data[:num_train], labels[:num_train], "float32", args.train_steps, 256, args.seed)
+        data, labels = data[num_train:], labels[num_train:]
+    net.eval()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    models = {}
+    for name, quantized in [("torchscript", False), ("torchscript_int8", True)]:
+        filename = os.path.join(args.output_dir, "net.pt" if not quantized else "net_int8.pt")
+        export_torchscript(net, filename, quantized)
+        models[name] = (ServedModel(filename).logits, os.path.getsize(filename))
+
+    def eager(chunks):
+        with torch.no_grad():
+            return net(chunks).numpy()
+
+    reference = eager(data)
+    report = {'chunks': len(data), 'threads': torch.get_num_threads(), 'models': {}}
+    for name, (fn, size) in [("eager", (eager, None))] + list(models.items()):
+        logits = fn(data)
+        p50, p99 = latency_ms(fn, data[:1], args.repeats)
+        report['models'][name] = {
+            'file_bytes': size,
+            'latency_ms_p50': p50,
+            'latency_ms_p99': p99,
+            'chunks_per_second': throughput(fn, data, args.batch_size),
+            'max_abs_logit_diff': float(np.abs(logits - reference).max()),
+            'argmax_agreement': float(np.mean(logits.argmax(1) == reference.argmax(1))),
+            'accuracy': float(np.mean(logits.argmax(1) == labels.numpy()))}
+        stats = report['models'][name]
+        print("%-17s p50 %6.3f ms  p99 %6.3f ms  %8.0f chunks/s  max |logit diff| %.2e  "
+              "argmax agreement %.4f  accuracy %.4f"
+              % (name, p50, p99, stats['chunks_per_second'], stats['max_abs_logit_diff'],
+                 stats['argmax_agreement'], stats['accuracy']))
+
+    with open(args.output, "w") as of:
+        json.dump(report, of, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,16 +9,20 @@ import pandas as pd
 
 import h5py
 
+import pianoRoll
+
 
 class ExtractSongs():
     
-    def __init__(self, data, data_type = "train"):
+    def __init__(self, data, data_type = "train", grid = None):
         """
-        Args:None 
+        Args:
+            grid : pianoRoll.TimeGrid of the columns (10 ms timeslices if None)
         """
         self.data_type = data_type
         self.dataset_name = data_type
         self.all_songs_df = data
+        self.grid = grid
 
         self.list_of_songs       = []
         self.label_list_of_songs = []
@@ -52,38 +56,6 @@ class ExtractSongs():
     def get_labels_list_of_songs(self): 
         return self.f_label_list_of_songs
         
-    def instrument_to_index(self, instrument):
-        """
-        Return the index of the category the instrument belongs to 
-        
-        Parameters
-        ----------
-        Instrument : instrument program number
-
-        Returns
-        -------
-        0  : instrument program number is in the piano category 
-        1  : instrument program number is in the guitar category
-        2  : instrument program number is in the string category
-        3  : instrument program number is in the bass category
-        -1 : instrument program number is not in our of the four desired categories
-        """
-        piano_program_numbers  = set([0, 1, 2, 3, 4])
-        guitar_program_numbers = set([25, 26, 27, 28, 29])
-        bass_program_numbers   = set([33, 34, 35, 36, 37, 38, 52])
-        string_program_numbers = set([41, 42, 43, 49, 50, 51])
-
-        if instrument in piano_program_numbers:
-            return 0
-        elif instrument in guitar_program_numbers:
-            return 1
-        elif instrument in string_program_numbers:
-            return 2 
-        elif instrument in bass_program_numbers:
-            return 3
-        else:
-            return -1
-        
     def construct_list_of_songs(self):
         """
         Import an array of midi files and output a list of songs 
@@ -91,28 +63,18 @@ class ExtractSongs():
         chunk is a numpy array. 
 
         """
-        T = 0.010   # Timestep (s)
         chunk_size      = 50
         chunk_offset    = self.chunk_step_size
-        num_notes       = 128
-        num_instruments = 4
+        num_notes       = pianoRoll.NUM_NOTES
+        num_instruments = pianoRoll.NUM_INSTRUMENTS
         
         # Iterate through every midi and extract chunks in each song 
-        for idx, row in self.all_songs_df.items():
-            t_end = row.get_end_time()
-            num_timeslices = int(t_end/T)
-
+        for idx, row in enumerate(pianoRoll.iter_songs(self.all_songs_df)):
             # Create data array to store all of the notes in the song based on the timestep they are played in 
-            data = np.zeros((num_notes * num_instruments, num_timeslices)) 
-            
-            for instrument in row.instruments:
-                index = self.instrument_to_index(instrument.program)
-                if (index != -1):
-                    for note in instrument.notes:
-                        data[num_notes * index + note.pitch, math.floor(note.start/T):math.floor(note.end/T)] = 1   
+            data = pianoRoll.rasterize(row, grid=self.grid)
             
             self.list_of_songs.append(data[0:num_notes*(num_instruments-1), :])
-            self.label_list_of_songs.append(data[num_notes*(num_instruments-1):num_notes, :])
+            self.label_list_of_songs.append(data[num_notes*(num_instruments-1):num_notes*num_instruments, :])
 
 
     def construct_list_of_chunks(self):
@@ -122,28 +84,16 @@ class ExtractSongs():
         chunk is a numpy array. 
 
         """
-        T = 0.010   # Timestep (s)
         chunk_size      = 50
         chunk_offset    = self.chunk_step_size
-        num_notes       = 128
-        num_instruments = 4
+        num_notes       = pianoRoll.NUM_NOTES
+        num_instruments = pianoRoll.NUM_INSTRUMENTS
         
         # Iterate through every midi and extract chunks in each song 
-#         for idx, row in self.all_songs_df.iterrows():
-        for idx, row in self.all_songs_df.items():
-#             t_end = row["midi"].get_end_time()
-            t_end = row.get_end_time()
-            num_timeslices = int(t_end/T)
-
+        for idx, row in enumerate(pianoRoll.iter_songs(self.all_songs_df)):
             # Create data array to store all of the notes in the song based on the timestep they are played in 
-            data = np.zeros((num_notes * num_instruments, num_timeslices)) # rows: notes, instruments, cols: timeslices
-            
-#             for instrument in row["midi"].instruments:
-            for instrument in row.instruments:
-                index = self.instrument_to_index(instrument.program)
-                if (index != -1):
-                    for note in instrument.notes:
-                        data[num_notes * index + note.pitch, math.floor(note.start/T):math.floor(note.end/T)] = 1   
+            data = pianoRoll.rasterize(row, grid=self.grid) # rows: notes, instruments, cols: timeslices
+            num_timeslices = data.shape[1]
 
             # Create chunks for a single song given its data array 
             list_of_chunks       = []
@@ -1,81 +1,260 @@
-import joblib
+import functools
 import glob
+import multiprocessing
 import os
+import time
 import pretty_midi
 
+import pianoRoll
+from instrumentation import pipeline
+from midiCache import MidiCache
+
 # PANDAS
 import pandas as pd
 
+
+# Number of batches between two evictions of the cache during a pass
+CACHE_EVICT_BATCHES = 16
+
+
+def has_all_instruments(program_numbers):
+    """
+    Checks if the program numbers contain all four desired instruments
+
+    Parameters
+    ----------
+    program numbers : list of program numbers
+
+    Returns
+    -------
+    True  : if program numbers contains all four desired instruments
+    False : otherwise
+    """
+    return not set(program_numbers).isdisjoint(pianoRoll.PIANO_PROGRAM_NUMBERS) and \
+           not set(program_numbers).isdisjoint(pianoRoll.GUITAR_PROGRAM_NUMBERS) and \
+           not set(program_numbers).isdisjoint(pianoRoll.BASS_PROGRAM_NUMBERS) and \
+           not set(program_numbers).isdisjoint(pianoRoll.STRING_PROGRAM_NUMBERS)
+
+
+def song_statistics(pm, midi_file):
+    """
+    Compute the json-serializable statistics of a parsed MIDI file.
+    """
+    return {'n_instruments': len(pm.instruments),
+            'program_numbers': [int(i.program) for i in pm.instruments if not i.is_drum],
+            'key_numbers': [int(k.key_number) for k in pm.key_signature_changes],
+            'tempos': [float(t) for t in pm.get_tempo_changes()[1]],
+            'end_time': float(pm.get_end_time()),
+            'path': midi_file}
+
+
+def parse_song(midi_file, cache=None):
+    """
+    Parse a MIDI file, or look it up in the cache, and extract its compact
+    note data if it has all four desired instruments.
+
+    Parameters
+    ----------
+    midi_file : str
+        Path to a MIDI file.
+    cache : MidiCache, optional
+        Cache to look the file up in before parsing it, and to store the
+        result in after parsing it.
+
+    Returns
+    -------
+    notes      : SongNotes of the song, or None if the file is invalid or is
+                 missing one of the instruments
+    statistics : dict of statistics, or None if the file is invalid
+    error      : error message if the file is invalid, None otherwise
+    cached     : True if the result came from the cache
+    """
+    if cache is not None:
+        cached = cache.get(midi_file)
+        if cached is not None:
+            notes, statistics = cached
+            error = "invalid MIDI file (cached)" if statistics is None else None
+            return notes, statistics, error, True
+
+    try:
+        pm = pretty_midi.PrettyMIDI(midi_file)
+    except Exception as e:
+        if cache is not None:
+            cache.put(midi_file, None, None)
+        return None, None, "%s: %s" % (type(e).__name__, e), False
+
+    statistics = song_statistics(pm, midi_file)
+    notes = None
+    if has_all_instruments(statistics['program_numbers']):
+        notes = pianoRoll.extract_notes(pm)._replace(path=midi_file)
+
+    if cache is not None:
+        cache.put(midi_file, notes, statistics)
+    return notes, statistics, None, False
+
+
+def load_song(midi_file, cache=None):
+    """
+    Return the SongNotes of a MIDI file if it has all four desired
+    instruments, None otherwise (see parse_song).
+    """
+    return parse_song(midi_file, cache)[0]
+
+
+def load_songs(midi_files, cache=None):
+    """
+    Parse a batch of MIDI files. This is the task run by the worker
+    processes: only compact note arrays, statistics and errors are sent back.
+
+    Returns
+    -------
+    records : list with one dict per file holding its path, notes,
+              statistics, error, whether it was cached and the time it took
+    """
+    records = []
+    for midi_file in midi_files:
+        t0 = time.perf_counter()
+        notes, statistics, error, cached = parse_song(midi_file, cache)
+        records.append({'path': midi_file,
+                        'notes': notes,
+                        'statistics': statistics,
+                        'error': error,
+                        'cached': cached,
+                        'seconds': time.perf_counter() - t0})
+    return records
+
+
 class ImportMIDI(): 
-    def __init__(self, num_files=1000): 
+    def __init__(self, num_files=1000, stream=False, cache_dir=None, cache_max_bytes=10 * 1024**3,
+                 n_jobs=None, batch_size=16, verbose=True, root_dir=os.path.join('..', 'lmd_aligned')): 
+        """
+        Args:
+            num_files       : maximum number of files of root_dir to import
+            stream          : do not parse anything here, songs are parsed and
+                              filtered while iterating over iter_songs()
+            cache_dir       : directory of the parsed MIDI cache (no cache if None)
+            cache_max_bytes : size the cache is trimmed to during and after each pass
+            n_jobs          : number of worker processes (number of cores if None,
+                              parse in this process if 1)
+            batch_size      : number of files parsed per worker task
+            verbose         : print a summary of each pass
+            root_dir        : root of the Lakh MIDI aligned tree, whose files are in
+                              <root_dir>/*/*/*/<track id>/*.mid
+        """
+        self.root_dir = root_dir
+        all_files = sorted(glob.glob(os.path.join(root_dir, '*', '*', '*', '*', '*.mid')))
+        self.files_to_use = all_files[0:num_files]
+        self.stream = stream
+        self.imported_MIDI_data = None
+
+        self.n_jobs     = n_jobs if n_jobs is not None else (os.cpu_count() or 1)
+        self.batch_size = batch_size
+        self.verbose    = verbose
+
+        # Summary of the last pass over the files, and (path, error) of every invalid file
+        self.report   = {}
+        self.failures = []
+
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = MidiCache(cache_dir, cache_max_bytes)
 
-        all_files = glob.glob(os.path.join('..', 'lmd_aligned', '*', '*', '*', '*', '*.mid'))
-        files_to_use = all_files[0:num_files]
-        statistics = joblib.Parallel(n_jobs=100, verbose=50)(
-            joblib.delayed(self.compute_statistics)(midi_file)
-            for midi_file in files_to_use)
-        # When an error occurred, None will be returned; filter those out.
-        statistics = [s for s in statistics if s is not None]
+        if self.stream:
+            return
 
-        df = pd.DataFrame(statistics)
+        # One row per kept song: the statistics of song_statistics and the
+        # SongNotes of the song in the 'notes' column (select it by name)
+        rows = []
+        for record in self.iter_records():
+            if record['notes'] is not None:
+                row = dict(record['statistics'])
+                row['notes'] = record['notes']
+                rows.append(row)
 
-        self.imported_MIDI_data = df[df["program_numbers"].apply(self.has_all_instruments)].reset_index(drop=True)
+        self.imported_MIDI_data = pd.DataFrame(rows)
         
  
-    def get_midi_data(self): 
-        return self.imported_MIDI_data 
-        
-    def compute_statistics(self, midi_file):
+    def __iter__(self): 
+        return self.iter_songs()
+
+    def iter_songs(self): 
+        """
+        Parse the files in worker processes and yield the SongNotes of every
+        file that has all four instruments, in file order. Filtered and
+        invalid files are dropped in the workers.
         """
-        Given a path to a MIDI file, compute a dictionary of statistics about it
+        for record in self.iter_records():
+            if record['notes'] is not None:
+                yield record['notes']
 
-        Parameters
-        ----------
-        midi_file : str
-            Path to a MIDI file.
+    def iter_records(self): 
+        """
+        Parse the files in batches of batch_size in a pool of n_jobs worker
+        processes and yield the record of every file (see load_songs), in
+        file order. Files already in the cache are not parsed again.
 
-        Returns
-        -------
-        statistics : dict
-            Dictionary reporting the values for different events in the file.
+        Counts and timings of the pass are stored in self.report and the
+        invalid files in self.failures.
         """
-        # Some MIDI files will raise Exceptions on loading, if they are invalid.
-        # We just skip those.
+        batches = [self.files_to_use[i:i + self.batch_size]
+                   for i in range(0, len(self.files_to_use), self.batch_size)]
+        load = functools.partial(load_songs, cache=self.cache)
+
+        report = {'files': 0, 'kept': 0, 'filtered': 0, 'failed': 0, 'cached': 0,
+                  'parse_seconds': 0.0, 'max_file_seconds': 0.0, 'wall_seconds': 0.0}
+        self.report   = report
+        self.failures = []
+        t0 = time.perf_counter()
+
+        n_jobs = min(self.n_jobs, len(batches))
+        if n_jobs <= 1:
+            results = map(load, batches)
+            pool = None
+        else:
+            pool = multiprocessing.Pool(n_jobs)
+            results = pool.imap(load, batches)
+
         try:
-            pm = pretty_midi.PrettyMIDI(midi_file)
-            # Extract informative events from the MIDI file
-            return {'n_instruments': len(pm.instruments),
-                    'program_numbers': [i.program for i in pm.instruments if not i.is_drum],
-                    'key_numbers': [k.key_number for k in pm.key_signature_changes],
-                    'tempos': list(pm.get_tempo_changes()[1]),
-                    'time_signature_changes': pm.time_signature_changes,
-                    'end_time': pm.get_end_time(),
-                    'lyrics': [l.text for l in pm.lyrics],
-                    'path': midi_file,
-                    'midi': pm}
-        # Silently ignore exceptions for a clean presentation (sorry Python!)
-        except Exception as e:
-            pass
+            for batch_idx, records in enumerate(results):
+                # Keep the cache within its size during long passes too
+                if self.cache is not None and batch_idx > 0 and batch_idx % CACHE_EVICT_BATCHES == 0:
+                    self.cache.evict()
+                for record in records:
+                    report['files'] += 1
+                    report['cached'] += record['cached']
+                    report['parse_seconds'] += record['seconds']
+                    report['max_file_seconds'] = max(report['max_file_seconds'], record['seconds'])
+                    pipeline.record("parse", record['seconds'])
+                    if record['error'] is not None:
+                        report['failed'] += 1
+                        self.failures.append((record['path'], record['error']))
+                    elif record['notes'] is None:
+                        report['filtered'] += 1
+                    else:
+                        report['kept'] += 1
+                    report['wall_seconds'] = time.perf_counter() - t0
+                    yield record
+        finally:
+            if pool is not None:
+                pool.terminate()
+            # Also when a streaming consumer stops early, so the cache stays within its size
+            if self.cache is not None:
+                self.cache.evict()
+
+        if self.verbose:
+            print("Files: ", report['files'], ", Kept: ", report['kept'], ", Filtered: ", report['filtered'],
+                  ", Failed: ", report['failed'], ", Cached: ", report['cached'])
+            print("Wall time: %.1f s, Parse time: %.1f s, Slowest file: %.2f s, Workers: %d"
+                  % (report['wall_seconds'], report['parse_seconds'], report['max_file_seconds'], max(n_jobs, 1)))
+
+    def get_midi_data(self): 
+        if self.stream:
+            return self.iter_songs()
+        return self.imported_MIDI_data 
         
     def has_all_instruments(self, program_numbers):
             """
             Checks if the program numbers contain all four desired instruments
-
-            Parameters
-            ----------
-            program numbers : list of program numbers
-
-            Returns
-            -------
-            True  : if program numbers contains all four desired instruments
-            False : otherwise
+            (see has_all_instruments)
             """
-            piano_program_numbers = set([0, 1, 2, 3, 4])
-            guitar_program_numbers = set([25, 26, 27, 28, 29])
-            bass_program_numbers = set([33, 34, 35, 36, 37, 38, 52])
-            string_program_numbers = set([41, 42, 43, 49, 50, 51])
-
-            return not set(program_numbers).isdisjoint(piano_program_numbers) and \
-                   not set(program_numbers).isdisjoint(guitar_program_numbers) and \
-                   not set(program_numbers).isdisjoint(bass_program_numbers) and \
-                   not set(program_numbers).isdisjoint(string_program_numbers) 
\ No newline at end of file
+            return has_all_instruments(program_numbers)
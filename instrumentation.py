@@ -0,0 +1,208 @@
+import json
+import time
+
+
+def _read_hwm_bytes():
+    """
+    Return the peak resident set size of this process since the last
+    reset_peak_rss() (bytes), or None where /proc/self/status is not available
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process (VmHWM, and ru_maxrss)
+    to its current size, for all the code of the process (Linux only).
+    Returns False if it cannot be reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+class _NullStage():
+    """
+    Stage returned when instrumentation is disabled: does nothing
+    """
+    items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class _Stage():
+    def __init__(self, instrumentation, name, items):
+        self.instrumentation = instrumentation
+        self.name  = name
+        self.items = items
+        self.peak  = None
+
+    def __enter__(self):
+        self.instrumentation._start_peak(self)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.t0
+        self.instrumentation._end_peak(self)
+        self.instrumentation.record(self.name, seconds, self.items, self.peak)
+        return False
+
+    def add_peak(self, peak):
+        if peak is not None:
+            self.peak = peak if self.peak is None else max(self.peak, peak)
+
+
+class Laps():
+    """
+    Splits the time of a piece of code run outside of the main process
+    (e.g. in a worker) into stages, to be sent back and added with
+    Instrumentation.record
+    """
+
+    def __init__(self):
+        self.t = time.perf_counter()
+        self.seconds = {}
+
+    def lap(self, name):
+        """
+        Add the time since the previous lap (or the creation) to stage name
+        """
+        now = time.perf_counter()
+        self.seconds[name] = self.seconds.get(name, 0.0) + now - self.t
+        self.t = now
+
+
+class Instrumentation():
+    """
+    Wall time, number of items and peak memory of the stages of the
+    pipeline (parsing, rasterization, labelling, writing, reading).
+
+    Stages are timed with
+
+        with pipeline.stage("write", items=1):
+            ...
+
+    or added from times measured elsewhere with record(). The peak memory
+    of a stage is the peak RSS of this process during the stage, measured by
+    resetting the peak at the start of the stage (Linux only, n/a
+    elsewhere). That reset is process-wide: while enabled, VmHWM and
+    ru_maxrss no longer give the lifetime peak of the process to any other
+    code. When disabled,
+    stage() returns a shared object that does nothing and record() returns
+    immediately, so instrumented code runs at full speed.
+    """
+
+    def __init__(self, enabled = False, callback = None):
+        """
+        Args:
+            enabled  : collect statistics
+            callback : function called as callback(name, seconds, items) at the
+                       end of every stage, e.g. to send them to a logger
+        """
+        self.enabled  = enabled
+        self.callback = callback
+        self.stages   = {}
+        # Stages whose peak memory is being measured, outermost first
+        self.open_stages = []
+
+    def enable(self, callback = None):
+        self.enabled = True
+        if callback is not None:
+            self.callback = callback
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stages = {}
+
+    def stage(self, name, items = 1):
+        """
+        Return a context manager timing a stage that processes items items.
+        Its items attribute can be changed in the block if the number of
+        items is only known there.
+        """
+        if not self.enabled:
+            return _NULL_STAGE
+        return _Stage(self, name, items)
+
+    def _start_peak(self, stage):
+        # Resetting the peak loses it for the enclosing stages, give it to them first
+        peak = _read_hwm_bytes()
+        if peak is None or not reset_peak_rss():
+            return
+        for open_stage in self.open_stages:
+            open_stage.add_peak(peak)
+        stage.add_peak(_read_hwm_bytes())
+        self.open_stages.append(stage)
+
+    def _end_peak(self, stage):
+        if stage in self.open_stages:
+            stage.add_peak(_read_hwm_bytes())
+            self.open_stages.remove(stage)
+
+    def record(self, name, seconds, items = 1, peak_rss = None):
+        """
+        Add seconds and items to a stage, and its peak RSS (bytes) if it was
+        measured
+        """
+        if not self.enabled:
+            return
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = {'calls': 0, 'seconds': 0.0, 'items': 0, 'peak_rss_bytes': None}
+        stats['calls']   += 1
+        stats['seconds'] += seconds
+        stats['items']   += items
+        if peak_rss is not None:
+            stats['peak_rss_bytes'] = max(stats['peak_rss_bytes'] or 0, peak_rss)
+        if self.callback is not None:
+            self.callback(name, seconds, items)
+
+    def report(self):
+        """
+        Return the statistics of every stage: number of calls, total wall
+        time, number of items, items per second and the highest peak RSS of
+        this process during a call of the stage (None for stages only added
+        with record(), e.g. from worker processes). Times of stages run in
+        worker processes are the sums over the workers, so they can exceed
+        the wall time.
+        """
+        report = {}
+        for name, stats in self.stages.items():
+            report[name] = dict(stats)
+            report[name]['items_per_second'] = stats['items']/stats['seconds'] if stats['seconds'] > 0 else 0.0
+        return report
+
+    def save_json(self, filename):
+        with open(filename, "w") as jf:
+            json.dump(self.report(), jf, indent=2)
+
+    def print_report(self):
+        for name, stats in self.report().items():
+            peak = stats['peak_rss_bytes']
+            print("%-16s %8.3f s  %10d items  %12.1f items/s  peak RSS %s"
+                  % (name, stats['seconds'], stats['items'], stats['items_per_second'],
+                     "%.0f MB" % (peak/1024**2) if peak is not None else "n/a"))
+
+
+# Instrumentation of the pipeline modules, disabled until pipeline.enable() is called
+pipeline = Instrumentation()
@@ -0,0 +1,90 @@
+import numpy as np
+
+import pianoRoll
+
+
+# Label encodings MidiToFile can store and MidiSavedDataset can return:
+#   single   : pitch of the bass note of the timeslice, 128 if no bass note is
+#              played. When several bass notes are played the highest one is
+#              kept, like the original per-note loop did
+#   highest  : same as single
+#   lowest   : pitch of the lowest bass note, 128 if no bass note is played
+#   multihot : the 128 bass rows, bit-packed along the pitch axis on disk
+LABEL_MODES = ["single", "highest", "lowest", "multihot"]
+
+# Label of a timeslice without any bass note
+NO_NOTE = pianoRoll.NUM_NOTES
+
+
+def encode_labels(bass_roll, mode = "single"):
+    """
+    Encode the bass rows of a piano roll as labels, for every timeslice at once.
+
+    Parameters
+    ----------
+    bass_roll : (128, timeslices) array of 0/1
+    mode      : one of LABEL_MODES
+
+    Returns
+    -------
+    labels : (1, timeslices) uint8 pitches for single/highest/lowest,
+             (16, timeslices) uint8 packed bits for multihot
+    """
+    on = bass_roll != 0
+    if mode == "multihot":
+        return np.packbits(on, axis=0)
+
+    played = on.any(axis=0)
+    if mode == "single" or mode == "highest":
+        pitch = on.shape[0] - 1 - np.argmax(on[::-1], axis=0)
+    elif mode == "lowest":
+        pitch = np.argmax(on, axis=0)
+    else:
+        raise ValueError("Unknown label mode %r, expected one of %s" % (mode, LABEL_MODES))
+
+    return np.where(played, pitch, NO_NOTE).astype(np.uint8)[np.newaxis, :]
+
+
+def decode_labels(labels, mode = "single"):
+    """
+    Return stored labels in the form given to the model: multihot labels are
+    unpacked to (128, timeslices), the other modes are returned unchanged.
+    """
+    if mode == "multihot":
+        return np.unpackbits(labels, axis=0, count=pianoRoll.NUM_NOTES)
+    return labels
+
+
+def label_rows(mode):
+    """
+    Number of stored rows of a label mode
+    """
+    if mode == "multihot":
+        return (pianoRoll.NUM_NOTES + 7) // 8
+    return 1
+
+
+def label_suffix(mode):
+    """
+    Suffix of the dataset or file name the labels of a mode are stored
+    under: single labels keep the original "labels" name, the other modes
+    are stored as "labels_<mode>"
+    """
+    if mode == "single":
+        return ""
+    return "_" + mode
+
+
+def stored_label_modes(label_modes):
+    """
+    Return the label modes a build stores: single labels are always stored,
+    followed by the other requested modes in order, without duplicates.
+    Highest labels are the single labels, so they are not stored again.
+    """
+    modes = ["single"]
+    for mode in label_modes:
+        if mode not in LABEL_MODES:
+            raise ValueError("Unknown label mode %r, expected one of %s" % (mode, LABEL_MODES))
+        if mode not in modes and mode != "highest":
+            modes.append(mode)
+    return modes
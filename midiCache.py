@@ -0,0 +1,154 @@
+import numpy as np
+
+import hashlib
+import json
+import os
+import tempfile
+
+import pianoRoll
+
+
+class MidiCache():
+    """
+    On-disk cache of parsed MIDI files. Each entry is one .npz file holding
+    the note arrays and statistics of a source file, keyed on the absolute
+    path, size and modification time of that file so edited files are
+    parsed again.
+
+    Entries are written to a temporary file and renamed into place, so many
+    worker processes can fill the cache at the same time. The total size of
+    the cache is bounded by evict(), which removes the least recently used
+    entries.
+    """
+
+    def __init__(self, cache_dir, max_bytes = 10 * 1024**3):
+        """
+        Args:
+            cache_dir : directory of the cache (created if needed)
+            max_bytes : size the cache is brought back under by evict()
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def key(self, midi_file):
+        """
+        Return the cache key of a MIDI file, or None if it cannot be stat'ed.
+        """
+        try:
+            st = os.stat(midi_file)
+        except OSError:
+            return None
+        identity = "%s\0%d\0%d" % (os.path.abspath(midi_file), st.st_size, st.st_mtime_ns)
+        return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def get(self, midi_file):
+        """
+        Look up a MIDI file.
+
+        Returns
+        -------
+        None if the file is not cached, otherwise a (notes, statistics) tuple
+        where notes is the SongNotes of the file (None for songs that were
+        filtered out) and statistics is a dict (None for invalid files).
+        """
+        key = self.key(midi_file)
+        if key is None:
+            return None
+        path = self.entry_path(key)
+
+        try:
+            with np.load(path, allow_pickle=False) as entry:
+                statistics = json.loads(str(entry["statistics"]))
+                notes = None
+                if bool(entry["has_notes"]):
+                    notes = pianoRoll.SongNotes(entry["start"], entry["end"], entry["pitch"],
+                                                entry["category"], float(entry["end_time"]), midi_file,
+                                                entry["beats"])
+        except (OSError, KeyError, ValueError):
+            # Missing, evicted or partially evicted entry, or entry written before beats were kept
+            return None
+
+        # Mark the entry as recently used for eviction
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return notes, statistics
+
+    def put(self, midi_file, notes, statistics):
+        """
+        Store the result of parsing a MIDI file.
+
+        Parameters
+        ----------
+        midi_file  : path of the source MIDI file
+        notes      : SongNotes of the file, or None if it was filtered out
+        statistics : json-serializable dict of statistics, or None if the file is invalid
+        """
+        key = self.key(midi_file)
+        if key is None:
+            return
+
+        arrays = {"statistics": np.array(json.dumps(statistics)),
+                  "has_notes": np.array(notes is not None)}
+        if notes is not None:
+            arrays.update(start=notes.start, end=notes.end, pitch=notes.pitch,
+                          category=notes.category, end_time=np.array(notes.end_time),
+                          beats=np.zeros(0) if notes.beats is None else np.asarray(notes.beats, dtype=np.float64))
+
+        # Write to a private file and rename it so readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=key, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self.entry_path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def size(self):
+        """
+        Return the total size in bytes of the cache entries.
+        """
+        return sum(size for path, size, mtime in self._entries())
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is under max_bytes.
+
+        Returns
+        -------
+        number of removed entries
+        """
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for path, size, mtime in entries)
+
+        removed = 0
+        for path, size, mtime in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                # Already removed by another process
+                pass
+            total -= size
+        return removed
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if not entry.name.endswith(".npz"):
+                continue
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((entry.path, st.st_size, st.st_mtime))
+        return entries
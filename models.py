@@ -1,7 +1,43 @@
+import contextlib
+
+import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+# Precisions Net can be trained and run in: float64 and float32 weights and
+# computations, or float32 weights with the convolutions and linear layers
+# autocast to bfloat16 (see precision_context)
+PRECISIONS = ["float64", "float32", "bfloat16"]
+
+
+def bf16_supported():
+    """
+    Return True if the CPU has native bfloat16 instructions (AVX512-BF16 or
+    AMX). Without them bfloat16 autocast still works but is emulated and slow.
+    """
+    avx512_bf16 = getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)
+    amx         = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)
+    return bool(avx512_bf16() or amx())
+
+
+def parameter_dtype(precision):
+    """
+    Return the dtype of the weights of Net for a precision
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision %r, expected one of %s" % (precision, PRECISIONS))
+    return torch.float64 if precision == "float64" else torch.float32
+
+
+def precision_context(precision, device_type = "cpu"):
+    """
+    Return the context to run the forward pass (and loss) of Net in for a
+    precision: bfloat16 autocast for "bfloat16", nothing otherwise
+    """
+    if precision == "bfloat16":
+        return torch.autocast(device_type, dtype=torch.bfloat16)
+    return contextlib.nullcontext()
 
 
 class Net(nn.Module):
@@ -20,22 +56,83 @@ class Net(nn.Module):
         out2 = (N2 - F2)/stride_2 + 1
         
         self.out_features = out2 / pool2 # use max pooling 
+        self.window_size  = N1
+        # Length of the flattened conv2 output, an int so the reshape in
+        # forward() does no float arithmetic and can be scripted
+        self.conv_width    = int(self.out_features)
+        self.flat_features = 16 * self.conv_width
         
         self.conv1 = nn.Conv1d(in_channels=384, out_channels=64,  kernel_size=F1, stride=stride_1)
         self.conv2 = nn.Conv1d(in_channels=64, out_channels=16, kernel_size=F2, stride=stride_2)
-        self.fc1 = nn.Linear(16 * int(self.out_features), 400)
+        self.fc1 = nn.Linear(self.flat_features, 400)
         self.fc2 = nn.Linear(400, 250)
         self.fc3 = nn.Linear(250, 129)
 
     def forward(self, x):
+        # Compact (uint8) batches are cast once, to the dtype of the weights
+        if not x.is_floating_point():
+            x = x.to(self.conv1.weight.dtype)
         x = F.relu(self.conv1(x))
 #         x = F.max_pool1d(F.relu(self.conv1(x)), 2)
         x = F.relu(self.conv2(x))
 #         x = F.max_pool1d(F.relu(self.conv2(x)), 2)
-        x = x.view(-1, 16 * int(self.out_features))
+        x = x.view(-1, self.flat_features)
         x = F.relu(self.fc1(x))
         x = F.relu(self.fc2(x))
         x = self.fc3(x)
         return x
 
+    @torch.jit.export
+    def forward_song(self, x, block_size: int = 2048):
+        """
+        Run the network on every window of a whole song at once. The
+        convolutions are computed once over the song instead of once per
+        window, then fc1..fc3 are applied to the conv2 outputs of every
+        window position, block_size positions at a time.
+
+        Gives the same outputs as forward() on each window of window_size
+        columns with a step of 1.
+
+        Parameters
+        ----------
+        x          : (384, T) or (batch, 384, T) tensor of whole songs
+        block_size : number of window positions sent through fc1..fc3 at once
+
+        Returns
+        -------
+        out : (T - window_size + 1, 129) or (batch, T - window_size + 1, 129)
+              tensor, out[..., p, :] is the output for the window starting at
+              column p
+        """
+        single_song = x.dim() == 2
+        if single_song:
+            x = x.unsqueeze(0)
+        batch = x.shape[0]
+
+        if not x.is_floating_point():
+            x = x.to(self.conv1.weight.dtype)
+
+        # No complete window in songs shorter than the window
+        if x.shape[-1] < self.window_size:
+            out = x.new_zeros((batch, 0, self.fc3.out_features))
+            if single_song:
+                return out[0]
+            return out
+        x = F.relu(self.conv1(x))
+        x = F.relu(self.conv2(x))
+
+        # (batch, 16, positions, out_features): the conv2 outputs seen by each window
+        windows = x.unfold(2, self.conv_width, 1).permute(0, 2, 1, 3)
+        num_positions = windows.shape[1]
+
+        out = []
+        for start in range(0, num_positions, block_size):
+            block = windows[:, start:start + block_size].reshape(-1, self.flat_features)
+            block = F.relu(self.fc1(block))
+            block = F.relu(self.fc2(block))
+            out.append(self.fc3(block).view(batch, -1, self.fc3.out_features))
+        out = torch.cat(out, dim=1)
 
+        if single_song:
+            return out[0]
+        return out
@@ -0,0 +1,348 @@
+import numpy as np
+
+import collections
+import math
+
+
+# Program numbers of the four instrument categories we keep
+PIANO_PROGRAM_NUMBERS  = set([0, 1, 2, 3, 4])
+GUITAR_PROGRAM_NUMBERS = set([25, 26, 27, 28, 29])
+BASS_PROGRAM_NUMBERS   = set([33, 34, 35, 36, 37, 38, 52])
+STRING_PROGRAM_NUMBERS = set([41, 42, 43, 49, 50, 51])
+
+T               = 0.010   # Timestep (s)
+NUM_NOTES       = 128
+NUM_INSTRUMENTS = 4
+
+# Lookup table from program number to category index (-1 for unused programs)
+_PROGRAM_TO_INDEX = np.full(128, -1, dtype=np.int8)
+_PROGRAM_TO_INDEX[list(PIANO_PROGRAM_NUMBERS)]  = 0
+_PROGRAM_TO_INDEX[list(GUITAR_PROGRAM_NUMBERS)] = 1
+_PROGRAM_TO_INDEX[list(STRING_PROGRAM_NUMBERS)] = 2
+_PROGRAM_TO_INDEX[list(BASS_PROGRAM_NUMBERS)]   = 3
+
+
+# Compact note data for one song: one entry per note of a kept instrument, and
+# the beat times of the song (used by beat grids, see TimeGrid)
+SongNotes = collections.namedtuple("SongNotes", ["start", "end", "pitch", "category", "end_time", "path", "beats"],
+                                   defaults=[None, None])
+
+
+def instrument_to_index(instrument):
+    """
+    Return the index of the category the instrument belongs to
+
+    Parameters
+    ----------
+    Instrument : instrument program number
+
+    Returns
+    -------
+    0  : instrument program number is in the piano category
+    1  : instrument program number is in the guitar category
+    2  : instrument program number is in the string category
+    3  : instrument program number is in the bass category
+    -1 : instrument program number is not in our of the four desired categories
+    """
+    if 0 <= instrument < 128:
+        return int(_PROGRAM_TO_INDEX[instrument])
+    return -1
+
+
+def extract_notes(pm):
+    """
+    Gather the notes of every kept instrument of a PrettyMIDI object into
+    flat numpy arrays.
+
+    Parameters
+    ----------
+    pm : pretty_midi.PrettyMIDI object
+
+    Returns
+    -------
+    notes : SongNotes with start/end times (s), pitch and category per note,
+            and the beat times (s) of the song
+    """
+    starts     = []
+    ends       = []
+    pitches    = []
+    categories = []
+    for instrument in pm.instruments:
+        index = instrument_to_index(instrument.program)
+        if (index != -1) and len(instrument.notes) > 0:
+            n = len(instrument.notes)
+            starts.append(np.fromiter((note.start for note in instrument.notes), np.float64, n))
+            ends.append(np.fromiter((note.end for note in instrument.notes), np.float64, n))
+            pitches.append(np.fromiter((note.pitch for note in instrument.notes), np.uint8, n))
+            categories.append(np.full(n, index, dtype=np.int8))
+
+    beats = pm.get_beats()
+    if len(starts) == 0:
+        return SongNotes(np.zeros(0), np.zeros(0), np.zeros(0, np.uint8), np.zeros(0, np.int8), pm.get_end_time(),
+                         beats=beats)
+
+    return SongNotes(np.concatenate(starts), np.concatenate(ends), np.concatenate(pitches),
+                     np.concatenate(categories), pm.get_end_time(), beats=beats)
+
+
+def iter_songs(data):
+    """
+    Iterate over the songs of a pandas Series (or any object with items())
+    of songs, or of any other iterable of songs such as ImportMIDI.iter_songs().
+    """
+    if hasattr(data, "items"):
+        for idx, row in data.items():
+            yield row
+    else:
+        for row in data:
+            yield row
+
+
+def as_song_notes(song):
+    """
+    Return the SongNotes of a song given either a PrettyMIDI object or SongNotes.
+    """
+    if isinstance(song, SongNotes):
+        return song
+    return extract_notes(song)
+
+
+class TimeGrid():
+    """
+    Times of the columns of the piano roll. Either fixed timeslices of step
+    seconds, or beat_subdivisions columns per beat of the song, following
+    its tempo changes (beat times from pretty_midi's get_beats).
+
+    A beat grid gives the same number of columns per bar whatever the tempo,
+    e.g. 4 columns per beat is 8 columns per second at 120 bpm instead of
+    100 with the default 10 ms grid.
+    """
+
+    def __init__(self, step = T, beat_subdivisions = None):
+        """
+        Args:
+            step              : length of a column (s) of the fixed grid
+            beat_subdivisions : number of columns per beat, None for the fixed grid
+        """
+        self.step = step
+        self.beat_subdivisions = beat_subdivisions
+
+    @classmethod
+    def from_meta(cls, meta):
+        """
+        Return the grid described by the metadata of a saved dataset (see meta)
+        """
+        if str(meta.get('grid', 'fixed')) == 'beats':
+            return cls(beat_subdivisions=int(meta['beat_subdivisions']))
+        return cls(step=float(meta.get('T', T)))
+
+    def meta(self):
+        """
+        Return the description of the grid saved with a dataset
+        """
+        if self.beat_subdivisions is not None:
+            return {'grid': 'beats', 'T': 0.0, 'beat_subdivisions': int(self.beat_subdivisions)}
+        return {'grid': 'fixed', 'T': float(self.step), 'beat_subdivisions': 0}
+
+    def __eq__(self, other):
+        return isinstance(other, TimeGrid) and self.meta() == other.meta()
+
+    def __repr__(self):
+        if self.beat_subdivisions is not None:
+            return "TimeGrid(beat_subdivisions=%d)" % self.beat_subdivisions
+        return "TimeGrid(step=%r)" % self.step
+
+    def column_bounds(self, notes):
+        """
+        Return the start times (s) of the columns of a beat grid, followed by
+        the end time of the last column
+        """
+        if notes.beats is None:
+            raise ValueError("A beat grid needs the beat times of the song, see extract_notes")
+        beats = np.asarray(notes.beats, dtype=np.float64)
+        if len(beats) == 0 or beats[0] > 0:
+            beats = np.concatenate([[0.0], beats])
+
+        # Continue the last beat interval (120 bpm without one) up to the end of the song
+        interval = beats[-1] - beats[-2] if len(beats) > 1 else 0.5
+        if beats[-1] < notes.end_time:
+            num_extra = int(np.ceil((notes.end_time - beats[-1])/interval))
+            beats = np.concatenate([beats, beats[-1] + interval * np.arange(1, num_extra + 1)])
+
+        n = self.beat_subdivisions
+        bounds = beats[:-1, np.newaxis] + np.diff(beats)[:, np.newaxis] * (np.arange(n)/n)
+        return np.append(bounds.reshape(-1), beats[-1])
+
+    def columns(self, notes, times):
+        """
+        Return the column containing each of times, and the number of
+        complete columns of the song
+        """
+        if self.beat_subdivisions is None:
+            return np.floor(times/self.step).astype(np.int64), int(notes.end_time/self.step)
+
+        bounds = self.column_bounds(notes)
+        columns = np.searchsorted(bounds, times, side="right") - 1
+        num_columns = int(np.searchsorted(bounds, notes.end_time, side="right")) - 1
+        return columns.astype(np.int64), num_columns
+
+
+# 10 ms timeslices
+DEFAULT_GRID = TimeGrid()
+
+
+def note_intervals(song, grid = None):
+    """
+    Convert the notes of a song into piano-roll rows and [start, end) column
+    intervals on the grid (DEFAULT_GRID if None), matching
+    data[num_notes * index + note.pitch, floor(note.start/T):floor(note.end/T)]
+    on the default grid
+
+    Parameters
+    ----------
+    song : PrettyMIDI object or SongNotes
+    grid : TimeGrid
+
+    Returns
+    -------
+    rows           : row of each note in the 512 row piano roll
+    starts         : first column of each note
+    ends           : one past the last column of each note
+    num_timeslices : number of columns in the song
+    """
+    notes = as_song_notes(song)
+    if grid is None:
+        grid = DEFAULT_GRID
+
+    rows   = NUM_NOTES * notes.category.astype(np.int64) + notes.pitch
+    starts, num_timeslices = grid.columns(notes, notes.start)
+    ends, _                = grid.columns(notes, notes.end)
+
+    # Python slicing clips to the array bounds, do the same here
+    starts = np.clip(starts, 0, num_timeslices)
+    ends   = np.clip(ends, 0, num_timeslices)
+    keep   = ends > starts
+
+    return rows[keep], starts[keep], ends[keep], num_timeslices
+
+
+def rasterize(song, dtype = np.uint8, grid = None):
+    """
+    Build the dense piano roll of a song: rows are notes for each instrument
+    (piano, guitar, string, bass), columns are timeslices of the grid
+    (length T by default).
+
+    Every cell covered by a note is gathered into one flat index array and
+    written at once instead of one slice assignment per note.
+
+    Parameters
+    ----------
+    song  : PrettyMIDI object or SongNotes
+    dtype : dtype of the returned array (uint8 by default)
+    grid  : TimeGrid of the columns (DEFAULT_GRID if None)
+
+    Returns
+    -------
+    data : (num_notes * num_instruments, num_timeslices) array of 0/1
+    """
+    rows, starts, ends, num_timeslices = note_intervals(song, grid)
+
+    data = np.zeros((NUM_NOTES * NUM_INSTRUMENTS, num_timeslices), dtype=dtype)
+    data.reshape(-1)[covered_cells(rows, starts, ends, num_timeslices)] = 1
+    return data
+
+
+def covered_cells(rows, starts, ends, num_columns):
+    """
+    Return the flat indices (row * num_columns + column) of every cell
+    covered by the [start, end) intervals.
+    """
+    lengths = ends - starts
+    before  = np.cumsum(lengths) - lengths   # cells belonging to earlier notes
+
+    cells = np.arange(lengths.sum(), dtype=np.int64)
+    cells += np.repeat(rows * num_columns + starts - before, lengths)
+    return cells
+
+
+def rasterize_loop(song):
+    """
+    Reference per-note implementation of rasterize, kept for benchmarking and
+    for checking the vectorized version.
+    """
+    num_notes       = NUM_NOTES
+    num_instruments = NUM_INSTRUMENTS
+
+    t_end = song.get_end_time()
+    num_timeslices = int(t_end/T)
+
+    data = np.zeros((num_notes * num_instruments, num_timeslices))
+    for instrument in song.instruments:
+        index = instrument_to_index(instrument.program)
+        if (index != -1):
+            for note in instrument.notes:
+                data[num_notes * index + note.pitch, math.floor(note.start/T):math.floor(note.end/T)] = 1
+    return data
+
+
+class SparsePianoRoll():
+    """
+    Piano roll of a song stored as one [start, end) column interval per note.
+    Memory scales with the number of notes instead of the song duration;
+    dense windows are built only when asked for.
+    """
+
+    def __init__(self, song, grid = None):
+        """
+        Args:
+            song : PrettyMIDI object or SongNotes
+            grid : TimeGrid of the columns (DEFAULT_GRID if None)
+        """
+        rows, starts, ends, num_timeslices = note_intervals(song, grid)
+        order = np.argsort(starts, kind="stable")
+
+        self.num_timeslices = num_timeslices
+        self.rows   = rows[order].astype(np.int16)
+        self.starts = starts[order].astype(np.int32)
+        self.ends   = ends[order].astype(np.int32)
+        # Running max of the note ends, used to skip notes that ended before a window
+        self.max_ends = np.maximum.accumulate(self.ends) if len(self.ends) > 0 else self.ends
+
+    @property
+    def shape(self):
+        return (NUM_NOTES * NUM_INSTRUMENTS, self.num_timeslices)
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.starts.nbytes + self.ends.nbytes + self.max_ends.nbytes
+
+    def window(self, start, stop, row_start = 0, row_stop = NUM_NOTES * NUM_INSTRUMENTS, dtype = np.uint8):
+        """
+        Return the dense block data[row_start:row_stop, start:stop] of the song.
+        """
+        width = stop - start
+        out = np.zeros((row_stop - row_start, width), dtype=dtype)
+
+        # Notes starting before the window end and possibly ending after its start
+        lo = np.searchsorted(self.max_ends, start, side="right")
+        hi = np.searchsorted(self.starts, stop, side="left")
+        rows   = self.rows[lo:hi].astype(np.int64)
+        starts = self.starts[lo:hi].astype(np.int64)
+        ends   = self.ends[lo:hi].astype(np.int64)
+
+        keep = (ends > start) & (rows >= row_start) & (rows < row_stop)
+        rows   = rows[keep] - row_start
+        starts = np.clip(starts[keep] - start, 0, width)
+        ends   = np.clip(ends[keep] - start, 0, width)
+
+        out.reshape(-1)[covered_cells(rows, starts, ends, width)] = 1
+        return out
+
+    def column(self, t, row_start = 0, row_stop = NUM_NOTES * NUM_INSTRUMENTS, dtype = np.uint8):
+        """
+        Return the dense column data[row_start:row_stop, t] of the song.
+        """
+        return self.window(t, t + 1, row_start, row_stop, dtype)[:, 0]
+
+    def to_dense(self, dtype = np.uint8):
+        return self.window(0, self.num_timeslices, dtype=dtype)
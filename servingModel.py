@@ -0,0 +1,60 @@
+import numpy as np
+
+import json
+
+import torch
+
+
+class ServedModel():
+    """
+    Net exported by exportModel.py, run for predictions on CPU.
+
+    Only needs torch and numpy: the TorchScript file holds the network, its
+    weights (float32, or int8 fc layers) and its metadata, so neither
+    models.py nor the dataset code is imported.
+    """
+
+    def __init__(self, filename, num_threads = None):
+        """
+        Args:
+            filename    : TorchScript file written by exportModel.export_torchscript
+            num_threads : number of threads torch uses, all cores if None
+        """
+        extra_files = {'meta.json': ""}
+        self.module = torch.jit.load(filename, map_location="cpu", _extra_files=extra_files)
+        self.module.eval()
+        self.meta = json.loads(extra_files['meta.json'])
+        self.window_size = self.meta['window_size']
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def logits(self, chunks):
+        """
+        Parameters
+        ----------
+        chunks : (384, window_size) or (batch, 384, window_size) array or
+                 tensor, uint8 or float
+
+        Returns
+        -------
+        logits : (batch, 129) float32 numpy array
+        """
+        x = torch.as_tensor(chunks)
+        if x.dim() == 2:
+            x = x.unsqueeze(0)
+        with torch.inference_mode():
+            return self.module(x).numpy()
+
+    def predict(self, chunks):
+        """
+        Return the predicted bass pitch of each chunk (128 for no note)
+        """
+        return np.argmax(self.logits(chunks), axis=1)
+
+    def song_logits(self, roll, block_size = 2048):
+        """
+        Return the (T - window_size + 1, 129) logits of every window of a
+        (384, T) piano roll, see Net.forward_song
+        """
+        with torch.inference_mode():
+            return self.module.forward_song(torch.as_tensor(roll), block_size).numpy()
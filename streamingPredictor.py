@@ -0,0 +1,266 @@
+import numpy as np
+
+import argparse
+import heapq
+import time
+
+import torch
+import torch.nn.functional as F
+
+import pianoRoll
+from models import Net
+
+
+# Rows of the piano roll given to the network: piano, guitar and string notes
+NUM_INPUT_ROWS = pianoRoll.NUM_NOTES * (pianoRoll.NUM_INSTRUMENTS - 1)
+
+
+def event_column(time):
+    """
+    Return the column an event at time (s) takes effect in, as rasterize does
+    """
+    return int(np.floor(time/pianoRoll.T))
+
+
+def song_events(song):
+    """
+    Return the note-on and note-off events of the piano, guitar and string
+    notes of a song, in time order, as given to StreamingPredictor.
+
+    Parameters
+    ----------
+    song : PrettyMIDI object or SongNotes
+
+    Returns
+    -------
+    events : list of (time (s), note_on, category, pitch), note-offs first
+             among events at the same time
+    """
+    notes = pianoRoll.as_song_notes(song)
+    keep = notes.category < pianoRoll.NUM_INSTRUMENTS - 1
+    events = [(float(t), True, int(c), int(p)) for t, c, p in zip(notes.start[keep], notes.category[keep],
+                                                                   notes.pitch[keep])]
+    events += [(float(t), False, int(c), int(p)) for t, c, p in zip(notes.end[keep], notes.category[keep],
+                                                                    notes.pitch[keep])]
+    events.sort()
+    return events
+
+
+class StreamingPredictor():
+    """
+    Run Net live on note events: the piano roll is built one 10 ms column
+    at a time, and every column gives the 129-way output of the window made
+    of the last window_size columns (silence before the first one).
+
+    Only the new column goes through the convolutions: the last conv1
+    inputs, conv1 outputs and conv2 outputs of the window are kept in ring
+    buffers, so each tick costs one conv1 column, one conv2 column and the
+    fc layers, whatever the window size. The outputs are the same as
+    Net.forward_song on the rasterized song.
+
+    The network labels the middle column of its window, so the output of
+    column c is the prediction for the bass of column c - label_delay.
+    """
+
+    def __init__(self, net, latency_budget = 0.010):
+        """
+        Args:
+            net            : trained Net, its weights dtype is used for the computations
+            latency_budget : time (s) a tick may take, slower ticks are counted in overruns
+        """
+        self.net   = net.eval()
+        self.dtype = net.conv1.weight.dtype
+        self.window_size    = net.window_size
+        self.label_delay    = net.window_size // 2
+        self.latency_budget = latency_budget
+        self.k1 = net.conv1.kernel_size[0]
+        self.k2 = net.conv2.kernel_size[0]
+        self.width = net.conv_width
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new stream: no note held, a window of silence
+        """
+        self.held   = np.zeros(NUM_INPUT_ROWS, dtype=np.int32)  # number of held notes of each row
+        self.events = []                                       # heap of (column, order, note_on, row)
+        self.num_events = 0
+        self.column     = 0                                     # next column to close
+        self.late_events = 0
+        self.latencies   = []
+
+        with torch.no_grad():
+            # Activations of silence, as in the window before the first column
+            inputs = torch.zeros((1, NUM_INPUT_ROWS, self.k1 + self.k2 - 1), dtype=self.dtype)
+            conv1 = F.relu(self.net.conv1(inputs))
+            conv2 = F.relu(self.net.conv2(conv1))
+        self.inputs = inputs[0, :, :self.k1].clone()   # last k1 input columns
+        self.conv1  = conv1[0, :, :self.k2].clone()    # last k2 conv1 columns
+        # Last width conv2 columns, stored twice so that conv2[:, head + 1:head + 1 + width]
+        # is always the window in time order without copying the ring around
+        self.conv2 = conv2[0].repeat(1, 2 * self.width)[:, :2 * self.width].clone()
+        self.head  = self.width - 1
+
+    def note_on(self, time, category, pitch):
+        self.push(time, True, category, pitch)
+
+    def note_off(self, time, category, pitch):
+        self.push(time, False, category, pitch)
+
+    def push(self, time, note_on, category, pitch):
+        """
+        Queue a note event of the piano (0), guitar (1) or string (2)
+        category, bass and other events are ignored. Events of a column that
+        is already closed are applied to the next column.
+        """
+        if not 0 <= category < pianoRoll.NUM_INSTRUMENTS - 1:
+            return
+        column = event_column(time)
+        if column < self.column:
+            self.late_events += 1
+            column = self.column
+        heapq.heappush(self.events, (column, self.num_events, note_on, pianoRoll.NUM_NOTES * category + pitch))
+        self.num_events += 1
+
+    def tick(self):
+        """
+        Close the next column with the events queued for it and run the
+        network on the window ending with it.
+
+        Returns
+        -------
+        column : index of the closed column
+        logits : (129,) numpy array of the output of the window ending at column
+        """
+        t0 = time.perf_counter()
+        while self.events and self.events[0][0] <= self.column:
+            column, order, note_on, row = heapq.heappop(self.events)
+            self.held[row] = self.held[row] + 1 if note_on else max(self.held[row] - 1, 0)
+
+        with torch.no_grad():
+            x = torch.from_numpy(self.held > 0).to(self.dtype)
+            self.inputs = torch.cat([self.inputs[:, 1:], x[:, None]], dim=1)
+            conv1 = F.relu(self.net.conv1(self.inputs[None]))[0]
+            self.conv1 = torch.cat([self.conv1[:, 1:], conv1], dim=1)
+            conv2 = F.relu(self.net.conv2(self.conv1[None]))[0, :, 0]
+
+            self.head = (self.head + 1) % self.width
+            self.conv2[:, self.head] = conv2
+            self.conv2[:, self.head + self.width] = conv2
+            window = self.conv2[:, self.head + 1:self.head + 1 + self.width].reshape(1, -1)
+            x = F.relu(self.net.fc1(window))
+            x = F.relu(self.net.fc2(x))
+            logits = self.net.fc3(x)[0].numpy()
+
+        column = self.column
+        self.column += 1
+        self.latencies.append(time.perf_counter() - t0)
+        return column, logits
+
+    def advance(self, now):
+        """
+        Close every column that ends before time now (s)
+
+        Returns
+        -------
+        list of (column, logits), see tick()
+        """
+        outputs = []
+        while (self.column + 1) * pianoRoll.T <= now:
+            outputs.append(self.tick())
+        return outputs
+
+    def stats(self):
+        """
+        Return the number of ticks, the median, 99th percentile and maximum
+        tick time (s), and the number of ticks over the latency budget
+        """
+        latencies = np.array(self.latencies)
+        if len(latencies) == 0:
+            return {'ticks': 0, 'p50': 0.0, 'p99': 0.0, 'max': 0.0, 'overruns': 0, 'late_events': self.late_events}
+        return {'ticks': len(latencies),
+                'p50': float(np.median(latencies)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+                'overruns': int(np.sum(latencies > self.latency_budget)),
+                'late_events': self.late_events}
+
+
+def replay(predictor, events, end_time, realtime = False):
+    """
+    Feed the events of a song to a predictor as if they were played live.
+
+    Parameters
+    ----------
+    predictor : StreamingPredictor
+    events    : list of (time, note_on, category, pitch), see song_events
+    end_time  : time (s) to stop at
+    realtime  : wait for the wall clock to reach each column before closing
+                it, instead of running as fast as possible
+
+    Returns
+    -------
+    logits : (num_columns, 129) array, the output of every column
+    """
+    predictor.reset()
+    outputs = []
+    t0 = time.perf_counter()
+    num_columns = int(end_time/pianoRoll.T)
+    next_event = 0
+    for column in range(num_columns):
+        while next_event < len(events) and event_column(events[next_event][0]) <= column:
+            predictor.push(*events[next_event])
+            next_event += 1
+        if realtime:
+            delay = (column + 1) * pianoRoll.T - (time.perf_counter() - t0)
+            if delay > 0:
+                time.sleep(delay)
+        outputs.append(predictor.tick()[1])
+    return np.array(outputs).reshape(-1, predictor.net.fc3.out_features)
+
+
+def main():
+    import pretty_midi
+    import syntheticMIDI
+
+    parser = argparse.ArgumentParser(description="Replay a MIDI file through the streaming predictor and check its "
+                                                 "outputs against Net.forward_song")
+    parser.add_argument("midi_file", nargs="?", default=None, help="a synthetic song is used without it")
+    parser.add_argument("--state-dict", default=None, help="weights saved with torch.save(net.state_dict(), PATH)")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds of the song to replay")
+    parser.add_argument("--realtime", action="store_true", help="replay at the speed of the song")
+    parser.add_argument("--latency-budget", type=float, default=0.010)
+    parser.add_argument("--num-threads", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    torch.manual_seed(args.seed)
+    torch.set_num_threads(args.num_threads)
+    net = Net().float()
+    if args.state_dict is not None:
+        net.load_state_dict(torch.load(args.state_dict, map_location="cpu"))
+    if args.midi_file is not None:
+        pm = pretty_midi.PrettyMIDI(args.midi_file)
+    else:
+        pm = syntheticMIDI.synthetic_song(args.seed, args.duration)
+    notes = pianoRoll.extract_notes(pm)
+    end_time = min(args.duration, notes.end_time)
+
+    predictor = StreamingPredictor(net, args.latency_budget)
+    logits = replay(predictor, song_events(notes), end_time, args.realtime)
+    stats = predictor.stats()
+    print("Ticks: %d, tick time p50 %.3f ms, p99 %.3f ms, max %.3f ms, overruns %d (budget %.1f ms), late events %d"
+          % (stats['ticks'], 1000 * stats['p50'], 1000 * stats['p99'], 1000 * stats['max'], stats['overruns'],
+             1000 * args.latency_budget, stats['late_events']))
+
+    # Same windows computed offline: the song preceded by window_size - 1 columns of silence
+    roll = pianoRoll.rasterize(notes)[:NUM_INPUT_ROWS, :len(logits)]
+    padded = np.concatenate([np.zeros((NUM_INPUT_ROWS, net.window_size - 1), dtype=roll.dtype), roll], axis=1)
+    with torch.no_grad():
+        reference = net.forward_song(torch.from_numpy(padded)).numpy()
+    print("Max |logit diff| with forward_song: %.2e, argmax agreement %.4f"
+          % (np.abs(logits - reference).max(), np.mean(logits.argmax(1) == reference.argmax(1))))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import numpy as np
+
+import argparse
+import hashlib
+import os
+
+import pretty_midi
+
+import pianoRoll
+
+
+# Program numbers of each category, one is picked per song (see importMIDI.has_all_instruments)
+CATEGORY_PROGRAM_NUMBERS = [sorted(pianoRoll.PIANO_PROGRAM_NUMBERS),
+                            sorted(pianoRoll.GUITAR_PROGRAM_NUMBERS),
+                            sorted(pianoRoll.STRING_PROGRAM_NUMBERS),
+                            sorted(pianoRoll.BASS_PROGRAM_NUMBERS)]
+
+# Pitch range of the notes of each category
+CATEGORY_PITCHES = [(48, 96), (40, 84), (55, 100), (28, 55)]
+
+
+def synthetic_song(seed, duration = 120.0, notes_per_second = 4.0, tempo_changes = 2, missing_instrument = False):
+    """
+    Build a reproducible random multi-instrument song: one instrument of
+    each of the piano, guitar, string and bass categories, with notes
+    following a random tempo map, and optionally a drum track.
+
+    Parameters
+    ----------
+    seed               : random seed, the same seed gives the same song
+    duration           : length of the song (s)
+    notes_per_second   : average number of notes per second of each instrument
+    tempo_changes      : number of tempo changes after the initial tempo
+    missing_instrument : leave out one category, so importMIDI filters the song out
+
+    Returns
+    -------
+    pm : pretty_midi.PrettyMIDI object
+    """
+    rng = np.random.RandomState(seed)
+    pm = pretty_midi.PrettyMIDI(initial_tempo=float(rng.uniform(70, 160)))
+
+    # pretty_midi has no public way to add tempo changes: add them to its
+    # tick scales, which write() saves as set_tempo messages
+    times  = np.sort(rng.uniform(0, duration, tempo_changes))
+    tempos = rng.uniform(70, 160, tempo_changes)
+    for time, tempo in zip(times, tempos):
+        pm._update_tick_to_time(pm.time_to_tick(duration) + 1)
+        pm._tick_scales.append((pm.time_to_tick(time), 60.0/(tempo * pm.resolution)))
+    pm._update_tick_to_time(pm.time_to_tick(duration) + 1)
+
+    categories = list(range(len(CATEGORY_PROGRAM_NUMBERS)))
+    if missing_instrument:
+        categories.remove(rng.randint(len(categories)))
+
+    num_notes = int(duration * notes_per_second)
+    for category in categories:
+        program = int(rng.choice(CATEGORY_PROGRAM_NUMBERS[category]))
+        instrument = pretty_midi.Instrument(program=program)
+        low, high = CATEGORY_PITCHES[category]
+        starts  = np.sort(rng.uniform(0, duration - 1.0, num_notes))
+        lengths = rng.exponential(0.4, num_notes) + 0.05
+        pitches = rng.randint(low, high, num_notes)
+        for start, length, pitch in zip(starts, lengths, pitches):
+            instrument.notes.append(pretty_midi.Note(velocity=int(rng.randint(40, 128)), pitch=int(pitch),
+                                                     start=float(start), end=float(min(start + length, duration))))
+        pm.instruments.append(instrument)
+
+    if rng.rand() < 0.5:
+        drums = pretty_midi.Instrument(program=0, is_drum=True)
+        for start in np.arange(0, duration - 0.5, 0.5):
+            drums.notes.append(pretty_midi.Note(velocity=100, pitch=36, start=float(start), end=float(start + 0.1)))
+        pm.instruments.append(drums)
+    return pm
+
+
+def write_corpus(root_dir, num_files, seed = 0, duration = 120.0, notes_per_second = 4.0, filtered_fraction = 0.1):
+    """
+    Write a reproducible corpus of synthetic songs laid out like the Lakh
+    MIDI aligned tree, <root_dir>/<A>/<B>/<C>/<track id>/<song>.mid, so it
+    can be read with ImportMIDI(root_dir=root_dir). Existing files are kept.
+
+    Parameters
+    ----------
+    root_dir          : root of the corpus
+    num_files         : number of MIDI files
+    seed              : seed of the corpus, file i uses seed * 1000003 + i
+    duration          : length of each song (s)
+    notes_per_second  : average number of notes per second of each instrument
+    filtered_fraction : fraction of songs missing an instrument
+
+    Returns
+    -------
+    files : list of the paths of the MIDI files, in order
+    """
+    files = []
+    for i in range(num_files):
+        song_seed = seed * 1000003 + i
+        track_id = "TRSYN" + hashlib.sha1(str(song_seed).encode("utf-8")).hexdigest()[:13].upper()
+        directory = os.path.join(root_dir, track_id[2], track_id[3], track_id[4], track_id)
+        midi_file = os.path.join(directory, "%08d.mid" % song_seed)
+        files.append(midi_file)
+        if os.path.exists(midi_file):
+            continue
+
+        missing = np.random.RandomState(song_seed).rand() < filtered_fraction
+        pm = synthetic_song(song_seed, duration, notes_per_second, missing_instrument=missing)
+        os.makedirs(directory, exist_ok=True)
+        pm.write(midi_file)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic MIDI corpus laid out like lmd_aligned")
+    parser.add_argument("root_dir")
+    parser.add_argument("--num-files", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=120.0)
+    parser.add_argument("--notes-per-second", type=float, default=4.0)
+    parser.add_argument("--filtered-fraction", type=float, default=0.1)
+    args = parser.parse_args()
+
+    files = write_corpus(args.root_dir, args.num_files, args.seed, args.duration, args.notes_per_second,
+                         args.filtered_fraction)
+    print("Files: ", len(files), ", Root: ", args.root_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import pianoRoll
+import syntheticMIDI
+from datasetFromFile import MidiSavedDataset
+from datasetToFile import MidiToFile
+
+
+def synthetic_songs(num_songs, duration = 10.0):
+    return [pianoRoll.extract_notes(syntheticMIDI.synthetic_song(seed, duration)) for seed in range(num_songs)]
+
+
+def test_resume_rejects_manifest_of_another_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    songs = synthetic_songs(5)
+    MidiToFile(songs[:2], "val", backend="npy", n_jobs=1)
+    MidiToFile(songs[:4], "val", backend="hdf5", n_jobs=1)
+    with pytest.raises(ValueError):
+        MidiToFile(songs, "val", backend="npy", n_jobs=1, mode="a")
+
+
+def test_resume_appends_to_the_same_backend(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    songs = synthetic_songs(4)
+    MidiToFile(songs[:2], "val", backend="npy", n_jobs=1)
+    resumed = MidiToFile(songs, "val", backend="npy", n_jobs=1, mode="a")
+    assert resumed.report['existing_songs'] == 2
+    assert resumed.report['songs'] == 2
+    assert len(MidiSavedDataset("val", backend="npy")) == resumed.length
+
+
+BAD_SONG_BUILD = """
+import numpy as np
+import pianoRoll
+import syntheticMIDI
+from datasetToFile import MidiToFile
+
+bad = pianoRoll.SongNotes(np.array([0.0]), np.array([1.0]), None, np.array([0], dtype=np.int8), 1.0)
+songs = [bad] + [pianoRoll.extract_notes(syntheticMIDI.synthetic_song(seed, 5.0)) for seed in range(30)]
+MidiToFile(songs, "val", n_jobs=2, max_pending=2)
+"""
+
+
+def test_failing_song_propagates_from_workers(tmp_path):
+    # Run in a subprocess so a hang fails the test instead of blocking the suite
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run([sys.executable, "-c", BAD_SONG_BUILD], cwd=str(tmp_path), capture_output=True,
+                            text=True, timeout=120, env=dict(os.environ, PYTHONPATH=root))
+    assert result.returncode != 0
+    assert "TypeError" in result.stderr
+
+
+def test_build_keeps_repeated_songs(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    a, b = synthetic_songs(2)
+    build = MidiToFile([a, b, a], "train", n_jobs=1)
+    assert build.report['songs'] == 3
+    assert build.report['skipped_songs'] == 0
@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+import torch
+
+from exportModel import export_torchscript
+from models import Net
+from servingModel import ServedModel
+
+
+@pytest.mark.parametrize("quantized", [False, True])
+def test_exported_model_matches_eager(tmp_path, quantized):
+    torch.manual_seed(0)
+    net = Net().float().eval()
+    filename = str(tmp_path / "net.pt")
+    export_torchscript(net, filename, quantized)
+    model = ServedModel(filename)
+
+    chunk = torch.randint(0, 2, (384, 50), dtype=torch.uint8)
+    with torch.no_grad():
+        expected = net(chunk.unsqueeze(0)).numpy()
+    # Dynamic int8 quantization of the fc layers changes the logits slightly
+    atol = 1e-2 if quantized else 1e-5
+    np.testing.assert_allclose(model.logits(chunk.numpy()), expected, atol=atol)
+
+    short_song = np.zeros((384, 30), dtype=np.uint8)
+    assert model.song_logits(short_song).shape == (0, 129)
@@ -0,0 +1,26 @@
+import pytest
+import torch
+
+from models import Net
+
+
+@pytest.mark.parametrize("num_columns", [30, 49, 50])
+def test_forward_song_short_songs(num_columns):
+    torch.manual_seed(0)
+    net = Net().float().eval()
+    x = torch.randint(0, 2, (384, num_columns), dtype=torch.uint8)
+    with torch.no_grad():
+        out = net.forward_song(x)
+        batch_out = net.forward_song(x.unsqueeze(0))
+
+    num_positions = max(0, num_columns - net.window_size + 1)
+    assert out.shape == (num_positions, 129)
+    assert batch_out.shape == (1, num_positions, 129)
+    if num_positions > 0:
+        with torch.no_grad():
+            assert torch.allclose(out[0], net(x[:, :net.window_size].unsqueeze(0))[0], atol=1e-5)
+
+
+def test_forward_song_short_song_scripted():
+    net = torch.jit.script(Net().float().eval())
+    assert net.forward_song(torch.zeros((384, 30), dtype=torch.uint8)).shape == (0, 129)